@@ -12,6 +12,20 @@ __all__ = ('Template',)
 class TemplateError(Exception): pass
 
 
+class LazyRender(object):
+    '''Response body rendered on the first iteration'''
+
+    def __init__(self, render, charset='utf-8'):
+        self.render = render
+        self.charset = charset
+
+    def __iter__(self):
+        body = self.render()
+        if isinstance(body, unicode):
+            body = body.encode(self.charset)
+        return iter([body])
+
+
 class Template(object):
     def __init__(self, *dirs, **kwargs):
         self.debug = kwargs.get('debug', True)  # bool
@@ -59,10 +73,21 @@ class Template(object):
 
     def render_to_response(self, template_name, data, env=None,
                            content_type='text/html'):
+        '''
+        Returns response with rendered template. Template is not rendered
+        for HEAD requests unless response body is read, so there is no
+        "Content-Length" header.
+        '''
         if env is not None:
             data['env'] = env
-        response =  Response(self.render(template_name, **data),
-                             content_type=content_type)
+        if env is not None and env.request.headers_only:
+            response = Response(content_type=content_type)
+            response.app_iter = LazyRender(
+                    lambda: self.render(template_name, **data),
+                    response.charset or 'utf-8')
+        else:
+            response = Response(self.render(template_name, **data),
+                                content_type=content_type)
         response.template = dict(
             name=template_name,
             data=data,
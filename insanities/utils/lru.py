@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['LRUCache']
+
+from threading import Lock
+
+# node fields
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    '''
+    Thread-safe mapping which keeps at most `maxsize` items, the least
+    recently used items are evicted first.
+
+    If `getsize` function is given, `maxsize` limits the total size of
+    values instead, `getsize(value)` is used as the size of each value.
+    '''
+
+    def __init__(self, maxsize=128, getsize=None):
+        self.maxsize = maxsize
+        self.getsize = getsize
+        self._lock = Lock()
+        self._clear()
+
+    def _clear(self):
+        self._size = 0
+        self._nodes = {}
+        # circular doubly linked list, root.next is the least recently used
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, node):
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+
+    def _sizeof(self, value):
+        return self.getsize(value) if self.getsize is not None else 1
+
+    def _append(self, node):
+        root = self._root
+        last = root[_PREV]
+        node[_PREV] = last
+        node[_NEXT] = root
+        last[_NEXT] = root[_PREV] = node
+
+    def get(self, key, default=None):
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is None:
+                return default
+            self._unlink(node)
+            self._append(node)
+            return node[_VALUE]
+
+    def __getitem__(self, key):
+        missing = self._root
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._unlink(node)
+                self._size -= self._sizeof(node[_VALUE])
+                node[_VALUE] = value
+            else:
+                node = [None, None, key, value]
+                self._nodes[key] = node
+            self._size += self._sizeof(value)
+            self._append(node)
+            while self._size > self.maxsize:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._nodes[oldest[_KEY]]
+                self._size -= self._sizeof(oldest[_VALUE])
+
+    def __delitem__(self, key):
+        with self._lock:
+            node = self._nodes.pop(key)
+            self._unlink(node)
+            self._size -= self._sizeof(node[_VALUE])
+
+    def pop(self, key, default=None):
+        with self._lock:
+            node = self._nodes.pop(key, None)
+            if node is None:
+                return default
+            self._unlink(node)
+            self._size -= self._sizeof(node[_VALUE])
+            return node[_VALUE]
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @property
+    def size(self):
+        '''Total size of values (number of items if there is no `getsize`)'''
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def __repr__(self):
+        return '%s(maxsize=%r)' % (self.__class__.__name__, self.maxsize)
@@ -1,32 +1,59 @@
 # -*- coding: utf-8 -*-
 
+# marks absent value in the journal
+_missing = object()
+
+
 class VersionedStorage(object):
+    '''
+    Attribute storage which can roll back changes. Changes are recorded in
+    a journal, so commit and rollback cost depends on the number of changes
+    since the last commit, not on the number of stored keys.
+    '''
+
     def __init__(self, *args, **kwargs):
-        self.__stack = [{}]
-        self.__dict__.update(dict(*args, **kwargs))
+        # (key, previous value or _missing) for each change
+        self.__dict__['_VersionedStorage__journal'] = []
+        # journal positions of commits, the first one is the empty storage
+        self.__dict__['_VersionedStorage__marks'] = [0]
+        self(**dict(*args, **kwargs))
 
     def _get_dict(self):
         d = self.__dict__.copy()
-        del d['_VersionedStorage__stack']
+        del d['_VersionedStorage__journal']
+        del d['_VersionedStorage__marks']
         return d
 
-    def _set_dict(self, value):
-        value['_VersionedStorage__stack'] = self.__stack
-        self.__dict__ = value
-
-    _dict_ = property(_get_dict, _set_dict)
+    _dict_ = property(_get_dict)
 
     @property
     def _modified(self):
-        return self.__stack[-1] != self._dict_
+        d = self.__dict__
+        checked = set()
+        for k, old in self.__journal[self.__marks[-1]:]:
+            if k not in checked:
+                checked.add(k)
+                if d.get(k, _missing) != old:
+                    return True
+        return False
+
+    def _undo(self, position):
+        journal = self.__journal
+        d = self.__dict__
+        while len(journal) > position:
+            k, old = journal.pop()
+            if old is _missing:
+                d.pop(k, None)
+            else:
+                d[k] = old
 
     def _commit(self):
         if self._modified:
-            self.__stack.append(self._dict_)
+            self.__marks.append(len(self.__journal))
 
     def _rollback(self):
-        if len(self.__stack) > 1:
-            self._dict_ = self.__stack.pop()
+        if len(self.__marks) > 1:
+            self._undo(self.__marks.pop())
 
     def as_dict(self):
         return self._dict_
@@ -34,25 +61,39 @@ class VersionedStorage(object):
     def __getitem__(self, k):
         return self.__dict__[k]
 
+    def __setattr__(self, k, v):
+        d = self.__dict__
+        self.__journal.append((k, d.get(k, _missing)))
+        d[k] = v
+
+    __setitem__ = __setattr__
+
     def __delitem__(self, k):
-        del self.__dict__[k]
+        d = self.__dict__
+        self.__journal.append((k, d.pop(k)))
 
-    __setitem__ = object.__setattr__
+    def __delattr__(self, k):
+        try:
+            del self[k]
+        except KeyError:
+            raise AttributeError(k)
 
     def __contains__(self, k):
-        return k in self._dict_
+        return k in self.__dict__ and k not in ('_VersionedStorage__journal',
+                                                '_VersionedStorage__marks')
 
     def __repr__(self):
         return repr(self._dict_)
 
     def __call__(self, **kwargs):
-        self.__dict__.update(**kwargs)
+        for k, v in kwargs.items():
+            self[k] = v
         return self
 
     def _mark( self ):
-        self.__stack.append(self._dict_)
-        return len(self.__stack) - 1
+        self.__marks.append(len(self.__journal))
+        return len(self.__marks) - 1
 
     def _sweep( self, mark ):
-        self._dict_ = self.__stack[mark]
-        del self.__stack[mark:]
+        self._undo(self.__marks[mark])
+        del self.__marks[mark:]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['PrefixTrie']
+
+
+class PrefixTrie(object):
+    '''
+    Maps string prefixes to values. Lookup returns values of all prefixes
+    the given string starts with, so the cost depends on the length of the
+    longest stored prefix, not on the number of stored prefixes.
+    '''
+
+    def __init__(self):
+        # node is a dict: char -> child node, None -> list of values
+        self._root = {}
+
+    def add(self, prefix, value):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def lookup(self, string):
+        '''Returns list of values stored for prefixes of `string`, values
+        of shorter prefixes come first'''
+        node = self._root
+        result = list(node.get(None, ()))
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                result.extend(node[None])
+        return result
+
+    def __repr__(self):
+        return '%s()' % self.__class__.__name__
@@ -1,4 +1,5 @@
 from .core import *
 from .filters import *
+from .cache import *
 from .testing import *
 from .http import *
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['cache_response', 'MemoryCache', 'FileCache']
+
+import os
+import time
+import hashlib
+import tempfile
+import cPickle
+from threading import Condition
+from .core import WebHandler
+from .http import Response
+from ..utils.lru import LRUCache
+
+
+class MemoryCache(object):
+    '''
+    In-process cache backend, `size` limits total size of cached bodies in
+    bytes, the least recently used entries are evicted first.
+    '''
+
+    def __init__(self, size=16*1024*1024):
+        self._cache = LRUCache(size, getsize=lambda entry: len(entry[-1]))
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache[key] = value
+
+
+class FileCache(object):
+    '''
+    Cache backend keeping entries in files of `directory`, so they are
+    shared by processes and survive restarts. Entries are replaced
+    atomically.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest())
+
+    def get(self, key):
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            stored_key, value = cPickle.load(f)
+        except Exception:
+            # broken file is treated as a miss and is replaced later
+            return None
+        finally:
+            f.close()
+        return value if stored_key == key else None
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            cPickle.dump((key, value), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, self._path(key))
+
+
+def default_key(env, data):
+    return env.request.host + env.request.path_qs
+
+
+class cache_response(WebHandler):
+    '''
+    Caches successful responses of the next handlers to GET requests for
+    `ttl` seconds, HEAD requests get cached responses too, but their
+    responses (possibly without body) are not stored:
+
+        match('/news', 'news') | cache_response(60) | news
+
+    key - function `key(env, data)` returning cache key (string) for the
+          request or None if response should not be cached (e.g. for logged
+          in users). By default host, path and query string are used.
+    vary - names of request headers, which values are added to the key.
+           Responses varying on other headers (e.g. "Accept-Encoding" set by
+           `compress`) are not cached.
+    backend - `MemoryCache` (default), `FileCache` or any object with
+              `get(key)` and `set(key, value)` methods.
+
+    Streaming responses, responses with "Set-Cookie" header and
+    "Cache-Control: private" or "no-store" are not cached. Expired response is made again by one request only, others get
+    the expired one meanwhile or wait for it at most `lock_timeout` seconds
+    if there is none. Keys which got response that can't be cached are not
+    waited for during `uncacheable_ttl` seconds.
+    '''
+
+    pure = True
+
+    def __init__(self, ttl, key=default_key, vary=(), backend=None,
+                 lock_timeout=10, uncacheable_ttl=10):
+        self.ttl = ttl
+        self.key = key
+        self.vary = tuple(vary)
+        self._vary_lower = set(header.lower() for header in self.vary)
+        self.backend = backend if backend is not None else MemoryCache()
+        self.lock_timeout = lock_timeout
+        self.uncacheable_ttl = uncacheable_ttl
+        # keys of responses being made
+        self._pending = set()
+        self._cond = Condition()
+        # key -> time until requests for it are not waited for
+        self._uncacheable = LRUCache(1024)
+
+    def handle(self, env, data, next_handler):
+        request = env.request
+        if request.method not in ('GET', 'HEAD'):
+            return next_handler(env, data)
+        key = self.key(env, data)
+        if key is None:
+            return next_handler(env, data)
+        for header in self.vary:
+            key += '\n' + request.headers.get(header, '')
+
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] > time.time():
+            return self._response(entry)
+        if request.method == 'HEAD' or self._is_uncacheable(key):
+            return next_handler(env, data)
+        # whether this request makes response for others
+        owner = True
+        deadline = time.time() + self.lock_timeout
+        with self._cond:
+            while key in self._pending:
+                if entry is not None:
+                    return self._response(entry)
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    owner = False
+                    break
+                self._cond.wait(timeout)
+                entry = self.backend.get(key)
+                if entry is not None and entry[0] > time.time():
+                    return self._response(entry)
+                if self._is_uncacheable(key):
+                    owner = False
+                    break
+            if owner:
+                self._pending.add(key)
+        try:
+            response = next_handler(env, data)
+            if self._cacheable(response):
+                self.backend.set(key, (time.time() + self.ttl,
+                                       response.status,
+                                       list(response.headerlist),
+                                       response.body))
+                self._uncacheable.pop(key)
+            else:
+                self._uncacheable[key] = time.time() + self.uncacheable_ttl
+        finally:
+            if owner:
+                with self._cond:
+                    self._pending.discard(key)
+                    self._cond.notify_all()
+        return response
+
+    def _is_uncacheable(self, key):
+        until = self._uncacheable.get(key)
+        return until is not None and until > time.time()
+
+    def _cacheable(self, response):
+        if response is None or response.status_int != 200 or \
+                not isinstance(response.app_iter, list) or \
+                'Set-Cookie' in response.headers:
+            return False
+        cache_control = response.cache_control
+        if cache_control.private or cache_control.no_store:
+            return False
+        for header in response.vary or ():
+            if header.lower() not in self._vary_lower:
+                return False
+        return True
+
+    def _response(self, entry):
+        expires, status, headerlist, body = entry
+        return Response(status=status, headerlist=list(headerlist),
+                        app_iter=[body])
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.ttl)
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['WebHandler', 'cases', 'handler', 'Reverse',
-           'locations']
+__all__ = ['WebHandler', 'WebFilter', 'FlatChain', 'cases', 'handler',
+           'pure', 'offload', 'Reverse', 'locations']
 
 import logging
 import types
 import httplib
+from copy import copy
+from threading import Lock
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 from webob.exc import HTTPException
-from .http import Request, Response
+from .http import Request, Response, FileIter
 from ..utils.storage import VersionedStorage
-from .url import URL
+from ..utils.trie import PrefixTrie
+from ..utils.lru import LRUCache
+from ..utils import cached_property
+from .url import URL, UrlTemplateSet, UrlBuilder
 
 
 
@@ -26,6 +33,17 @@ def prepare_handler(handler):
 class WebHandler(object):
     '''Base class for all request handlers.'''
 
+    #: Handler doesn't change `env` and `data` itself, so their state is not
+    #: saved before calling it
+    pure = False
+
+    #: Assert that pure handlers don't change `env` and `data` (debug mode)
+    debug_pure = False
+
+    # handler passes request to nested chains (which roll back their own
+    # changes), so `env` and `data` are checked only if it returns None
+    _nested_chains = False
+
     def __or__(self, next_handler):
         if hasattr(self, '_next_handler'):
             self._next_handler | next_handler
@@ -45,11 +63,25 @@ class WebHandler(object):
         # we are last in chain
         return {}
 
+    def _url_template(self):
+        '''UrlTemplate which must match `request.prefixed_path` for this
+        handler to pass the request further, or None if there is no such
+        template. Used by `cases` to compile dispatching.'''
+        return None
+
+    def _next_url_template(self):
+        next_handler = self.get_next()
+        if isinstance(next_handler, WebHandler):
+            return next_handler._url_template()
+        return None
+
     def __repr__(self):
         return '%s()' % self.__class__.__name__
 
     def __call__(self, env, data):
         next_handler = self.get_next()
+        if self.pure:
+            return self._handle_pure(env, data, next_handler)
         env._commit()
         data._commit()
         result = self.handle(env, data, next_handler)
@@ -60,18 +92,63 @@ class WebHandler(object):
                 data._rollback()
         return result
 
+    def _handle_pure(self, env, data, next_handler):
+        if not self.debug_pure:
+            return self.handle(env, data, next_handler)
+        state = env.as_dict(), data.as_dict()
+        next_called = []
+        def checked_next(env, data):
+            _assert_unchanged(self, env, data, state)
+            next_called.append(True)
+            return next_handler(env, data)
+        result = self.handle(env, data, checked_next)
+        if not next_called and (result is None or not self._nested_chains):
+            _assert_unchanged(self, env, data, state)
+        return result
+
     def get_next(self):
         if hasattr(self, '_next_handler'):
             return self._next_handler
         #XXX: may be FunctionWrapper?
         return lambda e, d: None
 
-    def as_wsgi(self):
+    def compile(self):
+        '''
+        Returns handler equivalent to the chain starting with this handler,
+        which runs filters of the chain in a loop instead of nested calls.
+        Branches of `cases` are compiled too. The chain should not be
+        changed after compilation.
+        '''
+        handlers = [self]
+        while hasattr(handlers[-1], '_next_handler'):
+            handlers.append(handlers[-1]._next_handler)
+        if len(handlers) == 1:
+            return self
+        # the last handler may be cases, which compiles its branches
+        handlers[-1] = handlers[-1].compile()
+        return FlatChain(handlers)
+
+    def as_wsgi(self, route_cache=None, max_body=None):
+        '''
+        Returns WSGI application.
+
+        route_cache - maximum number of routing results (url templates
+                      matches, compiled `cases` candidates) to keep in
+                      `env.route_cache` between requests. Disabled by default.
+        max_body - maximum size of request body in bytes, larger requests
+                   get "413 Request Entity Too Large", see
+                   `Request.limit_body`. Unlimited by default.
+        '''
+        route_cache = LRUCache(route_cache) if route_cache else None
         def wrapper(environ, start_response):
             env = VersionedStorage()
             env.request = Request(environ, charset='utf-8')
+            if route_cache is not None:
+                env.route_cache = route_cache
             data = VersionedStorage()
             try:
+                if max_body is not None:
+                    env.request.limit_body(max_body)
                 response = self(env, data)
                 if response is None:
                     logger.debug('Application returned None '
@@ -88,15 +165,148 @@ class WebHandler(object):
 
             headers = response.headers.items()
             start_response(response.status, headers)
-            return [response.body]
+            app_iter = response.app_iter
+            if env.request.headers_only:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+                return []
+            # whole file can be sent by server
+            if isinstance(app_iter, FileIter) and app_iter.length is None \
+                    and 'wsgi.file_wrapper' in environ:
+                app_iter = environ['wsgi.file_wrapper'](app_iter.file,
+                                                        app_iter.block_size)
+            return app_iter
         return wrapper
 
 
+def _assert_unchanged(handler, env, data, state):
+    assert (env.as_dict(), data.as_dict()) == state, \
+           '%r is declared pure, but it changed env or data' % handler
+
+
+def pure(handler):
+    '''Declares handler (function or WebHandler) side-effect free, see
+    `WebHandler.pure`'''
+    handler = prepare_handler(handler)
+    handler.pure = True
+    return handler
+
+
+class WebFilter(WebHandler):
+    '''
+    Base class for handlers which only decide whether request goes further
+    down the chain (possibly updating `env` and `data`) and don't wrap the
+    rest of the chain. Compiled chains call filters in a loop.
+    '''
+
+    def check(self, env, data):
+        '''Returns True if request should be passed to next handler.
+        This method should be overridden in subclasses.'''
+        return True
+
+    def handle(self, env, data, next_handler):
+        if self.check(env, data):
+            return next_handler(env, data)
+        return None
+
+
+def _is_plain_filter(handler):
+    return isinstance(handler, WebFilter) and \
+           type(handler).handle.im_func is WebFilter.handle.im_func
+
+
+class FlatChain(WebHandler):
+    '''
+    Linear chain of handlers produced by `WebHandler.compile`. Filters are
+    called in a loop, other handlers get the rest of the chain as next
+    handler. `env` and `data` are rolled back once if the chain returns
+    None; their state is not saved until the first handler which is not
+    pure. Filters overriding `handle` are called as other handlers.
+    '''
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self._steps = [(handler, _is_plain_filter(handler), handler.pure)
+                       for handler in handlers]
+
+    def __call__(self, env, data):
+        return self._run(env, data, 0)
+
+    def _run(self, env, data, start):
+        marks = None
+        result = None
+        steps = self._steps
+        for index in xrange(start, len(steps)):
+            handler, is_filter, is_pure = steps[index]
+            if marks is None and not is_pure:
+                marks = env._mark(), data._mark()
+            if is_filter:
+                if is_pure and self.debug_pure:
+                    state = env.as_dict(), data.as_dict()
+                    passed = handler.check(env, data)
+                    _assert_unchanged(handler, env, data, state)
+                else:
+                    passed = handler.check(env, data)
+                if passed:
+                    continue
+                break
+            if index + 1 < len(steps):
+                next_handler = lambda env, data, start=index+1: \
+                                    self._run(env, data, start)
+            else:
+                next_handler = lambda env, data: None
+            if is_pure:
+                result = handler._handle_pure(env, data, next_handler)
+            else:
+                result = handler.handle(env, data, next_handler)
+            break
+        if result is None and marks is not None:
+            env._sweep(marks[0])
+            data._sweep(marks[1])
+        return result
+
+    def compile(self):
+        return self
+
+    def _locations(self):
+        return self.handlers[0]._locations()
+
+    def _url_template(self):
+        return self.handlers[0]._url_template()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.handlers)
+
+
 class Reverse(object):
+    '''
+    Builds urls by names. Url locations are indexed once on creation, so
+    one instance should be created per application and bound to each
+    request with `bind` method:
 
-    def __init__(self, urls, env=None):
+        reverse = Reverse.from_handler(app)
+        ...
+        env.url_for = reverse.bind(env)
+
+    memo_size - number of built paths (by url name and params) to remember.
+    '''
+
+    def __init__(self, urls, env=None, memo_size=None):
         self.urls = urls
         self.env = env
+        # url name -> (path builder, host)
+        self._routes = dict((name, (UrlBuilder(data['builders'][::-1]),
+                                    u'.'.join(data.get('subdomains', []))))
+                            for name, data in urls.items())
+        self._memo = LRUCache(memo_size) if memo_size else None
+
+    def bind(self, env):
+        '''Returns Reverse sharing url index with this one and bound to env'''
+        reverse = copy(self)
+        reverse.env = env
+        # computed for previous env
+        reverse.__dict__.pop('_scheme_port', None)
+        return reverse
 
     @property
     def namespace(self):
@@ -121,52 +331,138 @@ class Reverse(object):
     def url_exists(self, name):
         return self.expand_name(name) in self.urls
 
-    def __call__(self, name, **kwargs):
-        name = self.expand_name(name)
-
-        data = self.urls[name]
-        host = u'.'.join(data.get('subdomains', []))
-
+    @cached_property
+    def _scheme_port(self):
         if self.env:
             host_splitted = self.env.request.host.split(':')
             port = host_splitted[1] if len(host_splitted) > 1 else None
             scheme_port = {'http': '80',
                            'https': '443'}.get(self.env.request.scheme, '80')
             port = port if port != scheme_port else None
-            scheme = self.env.request.scheme
-        else:
-            port = None
-            scheme = None
+            return self.env.request.scheme, port
+        return None, None
 
-        # path - urlencoded str
-        path = ''.join([b(**kwargs) for b in reversed(data['builders'])])
+    def __call__(self, name, **kwargs):
+        name = self.expand_name(name)
+        builder, host = self._routes[name]
+        scheme, port = self._scheme_port
+
+        path = None
+        if self._memo is not None:
+            try:
+                # equal values of different types (True and 1) may be
+                # converted to different urls
+                key = (name, frozenset([(k, type(v), v)
+                                        for k, v in kwargs.items()]))
+            except TypeError:
+                # unhashable url params
+                key = None
+            else:
+                path = self._memo.get(key)
+        if path is None:
+            # path - urlencoded str
+            path = builder(**kwargs)
+            if self._memo is not None and key is not None:
+                self._memo[key] = path
         return URL(path, scheme=scheme, host=host, port=port)
 
     @classmethod
-    def from_handler(cls, handler, env=None):
-        return cls(locations(handler), env=env)
+    def from_handler(cls, handler, env=None, **kwargs):
+        return cls(locations(handler), env=env, **kwargs)
 
 
 class cases(WebHandler):
+    '''
+    Tries handlers one by one and returns the first result which is not None.
+    Each handler rolls back its own changes, so cases itself is pure.
+    Prefixes and subdomains added to request by failed handler are reset.
+
+    With `compiled=True` handlers are indexed by static leading parts of
+    their url templates (`match`, `prefix`), so only handlers which can
+    match `request.prefixed_path` are tried. Templates matching the whole
+    path (`match`) without url params are found by a dict lookup, other
+    ones are merged into one regular expression, which finds the first of
+    them matching the path. The order is preserved.
+    '''
+
+    pure = True
+    _nested_chains = True
 
     def __init__(self, *handlers, **kwargs):
         self.handlers = []
         for handler in handlers:
             self.handlers.append(prepare_handler(handler))
+        self.compiled = kwargs.get('compiled', False)
+        self._index = None
 
     def __or__(self, next_handler):
         'cases needs to set next handler for each handler it keeps'
         for handler in self.handlers:
             handler | prepare_handler(next_handler)
+        # handlers may get url templates from appended chains
+        self._index = None
         return self
 
     def handle(self, env, data, next_handler):
-        for handler in self.handlers:
+        if not self.compiled:
+            handlers = self.handlers
+        elif 'route_cache' in env:
+            key = (self, env.request.prefixed_path)
+            handlers = env.route_cache.get(key)
+            if handlers is None:
+                handlers = env.route_cache[key] = self._candidates(key[1])
+        else:
+            handlers = self._candidates(env.request.prefixed_path)
+        request = env.request if 'request' in env else None
+        if request is not None:
+            route_state = request._route_state
+        for handler in handlers:
             result = handler(env, data)
             if result is None:
+                # prefixes and subdomains matched by failed handler
+                if request is not None:
+                    request._route_state = route_state
                 continue
             return result
 
+    def compile(self):
+        self.handlers = [handler.compile() for handler in self.handlers]
+        self._index = None
+        return self
+
+    def _build_index(self):
+        trie = PrefixTrie()
+        static = {}
+        whole = []
+        for i, handler in enumerate(self.handlers):
+            template = handler._url_template()
+            if template is None:
+                # handlers without template are stored under empty prefix
+                # and are tried for any path
+                trie.add('', i)
+            elif template.match_whole_str and template._is_static:
+                static.setdefault(template._static_prefix, []).append(i)
+            else:
+                trie.add(template._static_prefix, i)
+                if template.match_whole_str:
+                    whole.append((i, template))
+        return trie, static, set(i for i, t in whole), UrlTemplateSet(whole)
+
+    def _candidates(self, path):
+        if self._index is None:
+            self._index = self._build_index()
+        trie, static, whole, template_set = self._index
+        indexes = trie.lookup(path)
+        if whole.intersection(indexes):
+            # whole path templates before the first matching one can not
+            # match, those after it are checked as usual
+            first = template_set.first_match(path)
+            indexes = [i for i in indexes
+                       if i not in whole or (first is not None and i >= first)]
+        indexes.extend(static.get(path, ()))
+        indexes.sort()
+        return [self.handlers[i] for i in indexes]
+
     def _locations(self):
         locations = {}
         for handler in self.handlers:
@@ -181,6 +477,137 @@ class cases(WebHandler):
         return '%s(*%r)' % (self.__class__.__name__, self.handlers)
 
 
+def _copy_changes(source, storage):
+    '''Makes `storage` equal to `source` (VersionedStorage objects)'''
+    old = storage.as_dict()
+    new = source.as_dict()
+    for key in old:
+        if key not in new:
+            del storage[key]
+    for key, value in new.items():
+        if key not in old or old[key] is not value:
+            storage[key] = value
+
+
+class offload(WebHandler):
+    '''
+    Runs handler (and the chain after offload) in a thread pool, so blocking
+    handlers behind it occupy at most `pool` threads and can not starve all
+    server workers:
+
+        prefix('/reports') | offload(reports, pool=4, timeout=30)
+
+    pool - number of threads or a pool shared by several offloads (object
+           with `apply_async` method like `multiprocessing.pool.ThreadPool`).
+           Own pool is created on the first request.
+    timeout - seconds to wait for result, then "503 Service Unavailable" is
+              returned. Handler is not interrupted and finishes in its thread.
+
+    Handler gets copies of `env` and `data` (and of `env.request`, sharing
+    WSGI environ and input), changes (including attributes cached on the
+    request, like parsed body) are copied back only if response is got in
+    time, so handler finishing after timeout doesn't touch storages used by
+    outer handlers.
+    max_queue - maximum number of requests of this offload waiting for a free
+                thread, others get "503 Service Unavailable" with
+                "Retry-After: `retry_after`" header. Unlimited by default.
+    '''
+
+    pure = True
+    _nested_chains = True
+
+    def __init__(self, handler, pool=4, timeout=None, max_queue=None,
+                 retry_after=5):
+        self.handler = prepare_handler(handler)
+        if isinstance(pool, (int, long)):
+            self.size = pool
+            self.pool = None
+        else:
+            self.size = getattr(pool, '_processes', None)
+            self.pool = pool
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._pending = 0
+        self._lock = Lock()
+
+    def __or__(self, next_handler):
+        self.handler | prepare_handler(next_handler)
+        return self
+
+    def _get_pool(self):
+        with self._lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.size)
+            return self.pool
+
+    def handle(self, env, data, next_handler):
+        pool = self._get_pool()
+        with self._lock:
+            if self.max_queue is not None and self.size is not None and \
+                    self._pending >= self.size + self.max_queue:
+                response = self._unavailable()
+                response.headers['Retry-After'] = str(self.retry_after)
+                return response
+            self._pending += 1
+        task_env = VersionedStorage(env.as_dict())
+        task_request = None
+        if 'request' in env:
+            task_request = task_env.request = copy(env.request)
+        task_data = VersionedStorage(data.as_dict())
+        abandoned = []
+        result = pool.apply_async(self._run, (task_env, task_data, abandoned))
+        try:
+            response = result.get(self.timeout)
+        except TimeoutError:
+            abandoned.append(True)
+            logger.warning('%r timed out after %s seconds', self.handler,
+                           self.timeout)
+            return self._unavailable()
+        if response is not None:
+            if task_request is not None and 'request' in task_env and \
+                    task_env.request is task_request:
+                # route state and values cached by handler (parsed body,
+                # etc.), input can't be read again
+                env.request.__dict__.update(task_request.__dict__)
+                task_env.request = env.request
+            _copy_changes(task_env, env)
+            _copy_changes(task_data, data)
+        return response
+
+    def _run(self, env, data, abandoned):
+        # request is pending until it is handled, even if it timed out
+        try:
+            return self.handler(env, data)
+        except Exception:
+            # nobody gets the exception after timeout
+            if abandoned:
+                logger.exception('%r failed after timeout', self.handler)
+            raise
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _unavailable(self):
+        status_int = httplib.SERVICE_UNAVAILABLE
+        return Response(status=status_int,
+                        body='%d %s' % (status_int,
+                                        httplib.responses[status_int]))
+
+    def compile(self):
+        self.handler = self.handler.compile()
+        return self
+
+    def _locations(self):
+        return self.handler._locations()
+
+    def _url_template(self):
+        return self.handler._url_template()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.handler)
+
+
 class FunctionWrapper(WebHandler):
     '''Wrapper for handler represented by function'''
 
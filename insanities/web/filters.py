@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['match', 'method', 'static_files', 'ctype', 'prefix', 
-           'subdomain', 'namespace']
+__all__ = ['match', 'method', 'methods', 'static_files', 'compress', 'etag',
+           'max_body', 'render_json', 'ctype', 'prefix', 'subdomain',
+           'namespace']
 
 import logging
 import httplib
 import mimetypes
+import os
+import stat
+import zlib
+import json
+import hashlib
 from os import path
 from urllib import unquote
-from .core import WebHandler
-from .http import Response
+from .core import WebHandler, WebFilter, cases
+from .http import Response, JSONResponse, FileIter, json_dumps
 from .url import UrlTemplate
+from ..utils.lru import LRUCache
+from ..utils.trie import PrefixTrie
 
 
 logger = logging.getLogger(__name__)
@@ -21,7 +29,49 @@ def update_data(data, new_data):
         data[k] = v
 
 
-class match(WebHandler):
+#: content types worth compressing
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript',
+                      'application/x-javascript', 'application/json',
+                      'application/xml', 'application/xhtml+xml',
+                      'image/svg+xml')
+
+# content encoding -> zlib wbits
+_wbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def compressor(encoding, level=6):
+    '''Returns zlib compressor for "gzip" or "deflate" content encoding'''
+    return zlib.compressobj(level, zlib.DEFLATED, _wbits[encoding])
+
+
+def gzip_bytes(data, level=6):
+    '''Returns `data` compressed to gzip format'''
+    c = compressor('gzip', level)
+    return c.compress(data) + c.flush()
+
+
+def add_vary(response, header):
+    vary = response.vary or ()
+    if header not in vary:
+        response.vary = tuple(vary) + (header,)
+
+
+def match_url(template, env):
+    '''Matches `request.prefixed_path` against url template. Results are
+    cached in `env.route_cache` if there is one and template converters
+    don't depend on env.'''
+    path = env.request.prefixed_path
+    if template._cacheable and 'route_cache' in env:
+        key = (template, path)
+        result = env.route_cache.get(key)
+        if result is None:
+            result = env.route_cache[key] = template.match(path, env=env)
+        matched, kwargs = result
+        return matched, dict(kwargs)
+    return template.match(path, env=env)
+
+
+class match(WebFilter):
 
     def __init__(self, url, name, convs=None):
         self.url = url
@@ -31,86 +81,564 @@ class match(WebHandler):
     def _locations(self):
         return {self.url_name: {'builders': [self.builder]}}
 
-    def handle(self, env, data, next_handler):
-        matched, kwargs = self.builder.match(env.request.prefixed_path, env=env)
-        
+    def _url_template(self):
+        return self.builder
+
+    def check(self, env, data):
+        matched, kwargs = match_url(self.builder, env)
         if matched:
             env.current_url_name = self.url_name
             update_data(data, kwargs)
-            return next_handler(env, data)
-        return None
+        return matched
 
     def __repr__(self):
         return '%s(\'%s\', \'%s\')' % \
                 (self.__class__.__name__, self.url, self.url_name)
 
 
-class method(WebHandler):
+class method(WebFilter):
+
+    pure = True
+
     def __init__(self, *names):
         self._names = [name.upper() for name in names]
+        self._names_set = frozenset(self._names)
 
-    def handle(self, env, data, next_handler):
-        if env.request.method in self._names:
-            return next_handler(env, data)
-        return None
+    def check(self, env, data):
+        return env.request.method in self._names_set
+
+    def _url_template(self):
+        # path is not affected, so next handler decides
+        return self._next_url_template()
 
     def __repr__(self):
         return 'method(*%r)' % self._names
 
 
-class ctype(WebHandler):
+class methods(cases):
+    '''
+    Dispatches request to the handler given for its HTTP method:
+
+        match('/item', 'item') | methods(get=show, post=save)
+
+    HEAD requests are passed to GET handler unless HEAD handler is given.
+    Requests with other methods get "405 Method Not Allowed" response with
+    "Allow" header.
+    '''
+
+    def __init__(self, **handlers):
+        self._names = names = sorted(handlers)
+        super(methods, self).__init__(*[handlers[name] for name in names])
+        # method name -> index of handler, handlers may be replaced
+        # by compiled ones
+        self._indexes = {}
+        for i, name in enumerate(names):
+            self._indexes[name.upper()] = i
+        if 'GET' in self._indexes:
+            self._indexes.setdefault('HEAD', self._indexes['GET'])
+        self._allow = ', '.join(sorted(self._indexes))
+
+    def handle(self, env, data, next_handler):
+        index = self._indexes.get(env.request.method)
+        if index is None:
+            status_int = httplib.METHOD_NOT_ALLOWED
+            response = Response(status=status_int,
+                                body='%d %s' % (status_int,
+                                                httplib.responses[status_int]))
+            response.headers['Allow'] = self._allow
+            return response
+        return self.handlers[index](env, data)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join(['%s=%r' % (name, handler) for name, handler
+                                      in zip(self._names, self.handlers)]))
+
+
+class ctype(WebFilter):
 
     xml = 'application/xml'
     json = 'application/json'
     html = 'text/html'
     xhtml = 'application/xhtml+xml'
 
+    pure = True
+
     def __init__(self, *types):
         self._types = types
 
-    def handle(self, env, data, next_handler):
-        if env.request.content_type in self._types:
-            return next_handler(env, data)
-        return None
+    def check(self, env, data):
+        return env.request.content_type in self._types
+
+    def _url_template(self):
+        return self._next_url_template()
 
     def __repr__(self):
         return '%s(*%r)' % (self.__class__.__name__, self._types)
 
 
 class static_files(WebHandler):
-    def __init__(self, location, url='/static/'):
+    '''
+    Serves files from `location` directory under `url` prefix.
+
+    If `cache_size` is given, files not larger than `cache_max_file` are
+    kept in memory, `cache_size` limits total size of cached content in
+    bytes. Cached file is reloaded when its modification time or size
+    changes. Along with cached file its precompressed siblings
+    ("file.css.br", "file.css.gz") are loaded, if there is no ".gz" file and
+    content type is compressible, gzipped variant is made in memory. Variant
+    is chosen by "Accept-Encoding" request header.
+
+    `manifest` is a mapping of file names to fingerprinted ones (or path to
+    JSON file with it) made by `static_files.build_manifest`. Reversed urls
+    point to fingerprinted names, files requested by them are served with
+    far-future "Cache-Control" header (`max_age` seconds).
+    '''
+
+    pure = True
+
+    #: content types compressed in memory, if there is no ".gz" file
+    compress_types = COMPRESSIBLE_TYPES
+    #: encoding -> extension of precompressed file, in order of preference
+    encodings = (('br', '.br'), ('gzip', '.gz'))
+
+    def __init__(self, location, url='/static/', cache_size=None,
+                 cache_max_file=256*1024, manifest=None, max_age=365*24*3600):
         self.location = location
         self.url = url
+        if isinstance(manifest, basestring):
+            with open(manifest) as f:
+                manifest = json.load(f)
+        self.manifest = manifest or {}
+        # fingerprinted name -> file name
+        self._fingerprinted = dict([(v, k) for k, v in self.manifest.items()])
+        self.max_age = max_age
+        self.cache_max_file = cache_max_file
+        self.cache = None
+        if cache_size:
+            # file larger than the whole cache would evict everything
+            self.cache_max_file = min(cache_max_file, cache_size)
+            self.cache = LRUCache(cache_size, getsize=self._entry_size)
+
+    @classmethod
+    def build_manifest(cls, location, output=None, hash_length=12):
+        '''
+        Returns mapping of names of all files in `location` to fingerprinted
+        names with content hash ("css/app.css" -> "css/app.0123456789ab.css").
+        If `output` is given, manifest is written there in JSON format.
+        '''
+        manifest = {}
+        skip = output and path.abspath(output)
+        for dirpath, dirnames, filenames in os.walk(location):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = path.join(dirpath, filename)
+                if path.abspath(file_path) == skip:
+                    continue
+                digest = hashlib.md5()
+                f = open(file_path, 'rb')
+                try:
+                    for chunk in iter(lambda: f.read(FileIter.block_size), ''):
+                        digest.update(chunk)
+                finally:
+                    f.close()
+                name = path.relpath(file_path, location).replace(os.sep, '/')
+                base, ext = path.splitext(name)
+                manifest[name] = '%s.%s%s' % (base,
+                                              digest.hexdigest()[:hash_length],
+                                              ext)
+        if output:
+            with open(output, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        return manifest
 
     def construct_reverse(self):
         def url_for_static(part):
             while part.startswith('/'):
                 part = part[1:]
-            return path.join(self.url, part)
+            return path.join(self.url, self.manifest.get(part, part))
         return url_for_static
 
     def handle(self, env, data, next_handler):
         path_info = unquote(env.request.path)
         if path_info.startswith(self.url):
             static_path = path_info[len(self.url):]
-            while static_path[0] in ('.', '/', '~'):
+            while static_path[:1] in ('.', '/', '~'):
                 static_path = static_path[1:]
+            immutable = static_path in self._fingerprinted
+            if immutable:
+                static_path = self._fingerprinted[static_path]
             file_path = path.join(self.location, static_path)
-            if path.exists(file_path) and path.isfile(file_path):
-                mime = mimetypes.guess_type(file_path)[0]
-                response = Response()
-                if mime:
-                    response.content_type = mime
-                with open(file_path, 'r') as f:
-                    response.write(f.read())
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                file_stat = None
+            if file_stat is not None and stat.S_ISREG(file_stat.st_mode):
+                if self.cache is not None and \
+                        file_stat.st_size <= self.cache_max_file:
+                    response = self.cached_response(env.request, file_path,
+                                                    file_stat)
+                else:
+                    response = self.file_response(env.request, file_path,
+                                                  file_stat)
+                if immutable:
+                    response.headers['Cache-Control'] = \
+                            'public, max-age=%d, immutable' % self.max_age
                 return response
             else:
                 logger.info('Client requested non existent static data "%s"' % file_path)
                 return Response(status=404)
         return None
 
+    def file_response(self, request, file_path, file_stat):
+        '''
+        Returns response for a file with validators (ETag, Last-Modified).
+        Conditional requests get "304 Not Modified", requests with single
+        byte range get "206 Partial Content". File is read in chunks by
+        `FileIter`.
+        '''
+        response = self._response(mimetypes.guess_type(file_path)[0],
+                                  file_stat)
+        if self._not_modified(request, response):
+            return self._not_modified_response(response)
+        length = file_stat.st_size
+        content_range = self._content_range(request, response, length)
+        if response.status_int == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            return response
+        if request.headers_only:
+            if content_range is not None:
+                length = content_range.stop - content_range.start
+            response.content_length = length
+            return response
+
+        f = open(file_path, 'rb')
+        if content_range is not None:
+            f.seek(content_range.start)
+            length = content_range.stop - content_range.start
+            response.app_iter = FileIter(f, length=length)
+        else:
+            response.app_iter = FileIter(f)
+        response.content_length = length
+        return response
+
+    def cached_response(self, request, file_path, file_stat):
+        '''
+        Same as `file_response`, but file content is taken from memory
+        cache. Compressed variant is sent if client accepts it, byte ranges
+        are served for uncompressed content only.
+        '''
+        signature = (file_stat.st_mtime, file_stat.st_size)
+        entry = self.cache.get(file_path)
+        if entry is None or entry[0] != signature:
+            entry = self.cache[file_path] = self._load(file_path, signature)
+        signature, mime, body, variants = entry
+
+        response = self._response(mime, file_stat)
+        encoding = None
+        if variants:
+            add_vary(response, 'Accept-Encoding')
+            encoding = self._choose_encoding(request, variants)
+        if encoding is not None:
+            body = variants[encoding]
+            response.content_encoding = encoding
+            response.etag = '%s-%s' % (response.etag, encoding)
+            response.accept_ranges = None
+        if self._not_modified(request, response):
+            return self._not_modified_response(response)
+        if encoding is None:
+            content_range = self._content_range(request, response, len(body))
+            if response.status_int == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                return response
+            if content_range is not None:
+                body = body[content_range.start:content_range.stop]
+        response.body = body
+        return response
+
+    def _load(self, file_path, signature):
+        f = open(file_path, 'rb')
+        try:
+            body = f.read()
+        finally:
+            f.close()
+        mime = mimetypes.guess_type(file_path)[0]
+        variants = {}
+        for encoding, ext in self.encodings:
+            try:
+                f = open(file_path + ext, 'rb')
+            except IOError:
+                continue
+            try:
+                variants[encoding] = f.read()
+            finally:
+                f.close()
+        if 'gzip' not in variants and mime and \
+                mime.startswith(self.compress_types):
+            compressed = gzip_bytes(body)
+            if len(compressed) < len(body):
+                variants['gzip'] = compressed
+        return signature, mime, body, variants
+
+    @staticmethod
+    def _entry_size(entry):
+        signature, mime, body, variants = entry
+        return len(body) + sum([len(v) for v in variants.values()])
+
+    def _choose_encoding(self, request, variants):
+        if 'HTTP_ACCEPT_ENCODING' not in request.environ:
+            return None
+        for encoding, ext in self.encodings:
+            if encoding in variants and \
+                    request.accept_encoding.quality(encoding):
+                return encoding
+        return None
+
+    def _response(self, mime, file_stat):
+        response = Response()
+        if mime:
+            response.content_type = mime
+        mtime = int(file_stat.st_mtime)
+        response.etag = '%x-%x' % (mtime, file_stat.st_size)
+        response.last_modified = mtime
+        response.accept_ranges = 'bytes'
+        return response
+
+    def _content_range(self, request, response, length):
+        '''Returns content range for requests with single satisfiable
+        range, prepares "206" or "416" response'''
+        if request.range is None or \
+                not request.if_range.match_response(response):
+            return None
+        content_range = request.range.content_range(length)
+        if content_range is not None:
+            response.status = httplib.PARTIAL_CONTENT
+            response.content_range = content_range
+        elif len(request.range.ranges) == 1:
+            response.status = httplib.REQUESTED_RANGE_NOT_SATISFIABLE
+            response.headers['Content-Range'] = 'bytes */%d' % length
+            response.content_length = None
+        # multiple ranges are not supported, whole file is sent
+        return content_range
+
+    def _not_modified(self, request, response):
+        if 'HTTP_IF_NONE_MATCH' in request.environ:
+            return response.etag in request.if_none_match
+        if request.if_modified_since is not None:
+            return response.last_modified <= request.if_modified_since
+        return False
+
+    def _not_modified_response(self, response):
+        response.status = httplib.NOT_MODIFIED
+        response.content_length = None
+        return response
+
+
+class compress(WebHandler):
+    '''
+    Compresses responses of the next handlers with gzip or deflate
+    encoding accepted by client:
+
+        compress() | cases(...)
+
+    Only successful responses with content type starting with one of
+    `types` and body not shorter than `min_size` bytes are compressed.
+    Streaming bodies (`app_iter` which is not a list) are compressed chunk
+    by chunk as they are sent. Responses to HEAD requests get the same
+    headers as to GET, except "Content-Length" which is not known. Strong
+    ETag of compressed response is made weak and byte ranges are not
+    served for it.
+    '''
+
+    #: supported encodings in order of preference
+    encodings = ('gzip', 'deflate')
+
+    def __init__(self, min_size=512, types=COMPRESSIBLE_TYPES, level=6):
+        self.min_size = min_size
+        self.types = tuple(types)
+        self.level = level
+
+    def handle(self, env, data, next_handler):
+        response = next_handler(env, data)
+        request = env.request
+        if response is None or \
+                not self._compressible(response, request.headers_only):
+            return response
+        add_vary(response, 'Accept-Encoding')
+        encoding = self._choose_encoding(request)
+        if encoding is None:
+            return response
+        app_iter = response.app_iter
+        if request.headers_only:
+            # body is not sent
+            response.content_length = None
+        elif isinstance(app_iter, list):
+            c = compressor(encoding, self.level)
+            response.body = c.compress(''.join(app_iter)) + c.flush()
+        else:
+            response.app_iter = CompressIter(app_iter,
+                                             compressor(encoding, self.level))
+            response.content_length = None
+        response.content_encoding = encoding
+        # byte ranges of uncompressed body don't apply to compressed one
+        response.accept_ranges = None
+        # strong ETag becomes weak one, so it still matches "If-None-Match"
+        # checked by the next handlers against uncompressed response
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+        return response
+
+    def _compressible(self, response, headers_only=False):
+        if response.status_int != httplib.OK or response.content_encoding:
+            return False
+        content_type = response.content_type
+        if not content_type or not content_type.startswith(self.types):
+            return False
+        # body of response to HEAD request may be omitted
+        if isinstance(response.app_iter, list) and not headers_only:
+            return sum([len(chunk) for chunk in response.app_iter]) >= \
+                    self.min_size
+        # length of streaming body may be unknown
+        return response.content_length is None or \
+                response.content_length >= self.min_size
+
+    def _choose_encoding(self, request):
+        if 'HTTP_ACCEPT_ENCODING' not in request.environ:
+            return None
+        for encoding in self.encodings:
+            if request.accept_encoding.quality(encoding):
+                return encoding
+        return None
+
+    def __repr__(self):
+        return '%s(min_size=%r)' % (self.__class__.__name__, self.min_size)
+
+
+class CompressIter(object):
+    '''Compresses chunks of `app_iter` by zlib compressor `c`'''
+
+    def __init__(self, app_iter, c):
+        self.app_iter = app_iter
+        self.c = c
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            chunk = self.c.compress(chunk)
+            if chunk:
+                yield chunk
+        yield self.c.flush()
+
+    def close(self):
+        # closes app_iter even if iteration was not started
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class etag(WebHandler):
+    '''
+    Sets weak ETag for successful responses of the next handlers to GET
+    and HEAD requests and answers "304 Not Modified" to requests with
+    matching "If-None-Match":
+
+        match('/news', 'news') | etag() | news
+
+    ETag is a hash of the response body, so the response is still made,
+    only sending it is saved. Streaming responses and responses to HEAD
+    requests are left as is. If `version` function is given, ETag is made of `version(env, data)`
+    result (e.g. revision of the shown model) and matching requests get
+    "304 Not Modified" without calling next handlers. If it returns None,
+    body hash is used.
+    '''
+
+    pure = True
+
+    def __init__(self, version=None):
+        self.version = version
+
+    def handle(self, env, data, next_handler):
+        request = env.request
+        if request.method not in ('GET', 'HEAD'):
+            return next_handler(env, data)
+        tag = None
+        if self.version is not None:
+            key = self.version(env, data)
+            if key is not None:
+                tag = hashlib.md5(repr(key)).hexdigest()
+                if tag in request.if_none_match:
+                    return self._not_modified(Response(), tag)
+        response = next_handler(env, data)
+        if response is None or response.status_int != httplib.OK or \
+                'ETag' in response.headers:
+            return response
+        if tag is None:
+            # body of response to HEAD request may be omitted, so its hash
+            # differs from the one sent for GET
+            if request.headers_only or \
+                    not isinstance(response.app_iter, list):
+                return response
+            tag = hashlib.md5(''.join(response.app_iter)).hexdigest()
+        if tag in request.if_none_match:
+            return self._not_modified(response, tag)
+        response.headers['ETag'] = 'W/"%s"' % tag
+        return response
+
+    def _not_modified(self, response, tag):
+        response.status = httplib.NOT_MODIFIED
+        response.headers['ETag'] = 'W/"%s"' % tag
+        response.app_iter = []
+        response.content_length = None
+        return response
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.version)
+
+
+class max_body(WebHandler):
+    '''
+    Limits request body size to `size` bytes, requests with larger
+    "Content-Length" get "413 Request Entity Too Large" before the body is
+    read. Reading bodies without "Content-Length" is bounded as well (see
+    `Request.limit_body`):
+
+        max_body(1024*1024, per_route={'/upload/': 100*1024*1024})
+
+    per_route - limits for paths starting with given prefixes, the longest
+                matching prefix is used.
+    '''
 
-class prefix(WebHandler):
+    pure = True
+
+    def __init__(self, size, per_route=None):
+        self.size = size
+        self.per_route = per_route or {}
+        self._trie = PrefixTrie()
+        for route_prefix, route_size in self.per_route.items():
+            self._trie.add(route_prefix, route_size)
+
+    def handle(self, env, data, next_handler):
+        request = env.request
+        sizes = self._trie.lookup(request.path)
+        size = sizes[-1] if sizes else self.size
+        if request.content_length is not None and \
+                request.content_length > size:
+            status_int = httplib.REQUEST_ENTITY_TOO_LARGE
+            return Response(status=status_int,
+                            body='%d %s' % (status_int,
+                                            httplib.responses[status_int]))
+        request.limit_body(size)
+        return next_handler(env, data)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.size)
+
+
+def render_json(dumps=json_dumps):
+    '''Returns handler responding with `data` serialized to JSON'''
+    def renderer(env, data, next_handler):
+        return JSONResponse(data.as_dict(), dumps=dumps)
+    return renderer
+
+
+class prefix(WebFilter):
     def __init__(self, _prefix, convs=None):
         self.builder = UrlTemplate(_prefix, match_whole_str=False, 
                                    converters=convs)
@@ -121,19 +649,21 @@ class prefix(WebHandler):
             v.setdefault('builders', []).append(self.builder)
         return locations
 
-    def handle(self, env, data, next_handler):
-        matched, kwargs = self.builder.match(env.request.prefixed_path, env=env)
+    def _url_template(self):
+        return self.builder
+
+    def check(self, env, data):
+        matched, kwargs = match_url(self.builder, env)
         if matched:
             update_data(data, kwargs)
             env.request.add_prefix(self.builder(**kwargs))
-            return next_handler(env, data)
-        return None
+        return matched
 
     def __repr__(self):
         return '%s(\'%r\')' % (self.__class__.__name__, self.builder)
 
 
-class subdomain(WebHandler):
+class subdomain(WebFilter):
     def __init__(self, _subdomain):
         self.subdomain = unicode(_subdomain)
 
@@ -143,7 +673,10 @@ class subdomain(WebHandler):
             v.setdefault('subdomains', []).append(self.subdomain)
         return locations
 
-    def handle(self, env, data, next_handler):
+    def _url_template(self):
+        return self._next_url_template()
+
+    def check(self, env, data):
         subdomain = env.request.subdomain
         #XXX: here we can get 'idna' encoded sequence, that is the bug
         if self.subdomain:
@@ -155,24 +688,23 @@ class subdomain(WebHandler):
 
         if matches:
             env.request.add_subdomain(self.subdomain)
-            return next_handler(env, data)
-        return None
+        return matches
 
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.subdomain)
 
 
-class namespace(WebHandler):
+class namespace(WebFilter):
     def __init__(self, ns):
         # namespace is str
         self.namespace = ns
 
-    def handle(self, env, data, next_handler):
+    def check(self, env, data):
         if 'namespace' in env:
             env.namespace += '.' + self.namespace
         else:
             env.namespace = self.namespace
-        return next_handler(env, data)
+        return True
 
     def _locations(self):
         locations = super(namespace, self)._locations()
@@ -180,3 +712,7 @@ class namespace(WebHandler):
         for k, v in locations.items():
             new_locations[self.namespace+'.'+k if k else self.namespace] = v
         return new_locations
+
+    def _url_template(self):
+        return self._next_url_template()
+
@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['Request', 'Response']
+__all__ = ['Request', 'Response', 'JSONResponse', 'FileIter', 'LimitedInput']
 
 import logging
 import httplib
 import cgi
 from webob import Request as _Request, Response
 from webob.multidict import MultiDict, NoVars, UnicodeMultiDict
+from webob.exc import HTTPBadRequest, HTTPRequestEntityTooLarge
+try:
+    # faster on python 2
+    import simplejson as json
+except ImportError:
+    import json
 
 from ..utils import cached_property
+from .multipart import MultipartParser, MultipartError, MultipartLimitError
 
 logger = logging.getLogger(__name__)
 
@@ -19,13 +26,26 @@ class Request(_Request):
     Patched webob Request class
     '''
 
+    #: uploaded files larger than that (in bytes) are spooled to disk
+    multipart_memory_limit = 1024 * 1024
+    #: maximum size of a multipart part (file or field) in bytes
+    max_part_size = None
+    #: maximum size of multipart body in bytes
+    max_body_size = None
+    #: maximum size of JSON body in bytes
+    max_json_size = 1024 * 1024
+
     def __init__(self, *args, **kwargs):
         super(Request, self).__init__(*args, **kwargs)
-        self._prefixes = []
+        # total length of prefixes matched by `prefix` filters
+        self._prefix_length = 0
+        # subdomains matched by `subdomain` filters
         self._subdomain = ''
+        # (SCRIPT_NAME, PATH_INFO) -> quoted path
+        self._path_key = self._path = None
 
     def add_prefix(self, prefix):
-        self._prefixes.append(prefix)
+        self._prefix_length += len(prefix)
 
     def add_subdomain(self, subdomain):
         if self._subdomain and subdomain:
@@ -33,48 +53,243 @@ class Request(_Request):
         elif subdomain:
             self._subdomain = subdomain
 
+    def _get_route_state(self):
+        return self._prefix_length, self._subdomain
+
+    def _set_route_state(self, state):
+        self._prefix_length, self._subdomain = state
+
+    #: state changed by `add_prefix` and `add_subdomain`, restored by
+    #: `cases` when a handler returns None
+    _route_state = property(_get_route_state, _set_route_state)
+
+    def _quoted_path(self):
+        environ = self.environ
+        key = (environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', ''))
+        if key != self._path_key:
+            self._path_key, self._path = key, self.path
+        return self._path
+
     # We need to inject code which works with
     # prefixes
     @property
     def prefixed_path(self):
-        path = self.path
-        if self._prefixes:
-            length = sum(map(len, self._prefixes))
-            path = path[length:]
-        return path
+        return self._quoted_path()[self._prefix_length:]
 
     @property
     def prefixed_path_qs(self):
-        path = self.path_qs
-        if self._prefixes:
-            length = sum(map(len, self._prefixes))
-            path = path[length:]
-        return path
+        return self.path_qs[self._prefix_length:]
+
+    def limit_body(self, max_size):
+        '''
+        Limits request body to `max_size` bytes: raises
+        `HTTPRequestEntityTooLarge` if "Content-Length" is greater, otherwise
+        "wsgi.input" is wrapped by `LimitedInput`, so bodies without
+        "Content-Length" are bounded too. The last given limit is used.
+        '''
+        if self.content_length is not None and self.content_length > max_size:
+            raise HTTPRequestEntityTooLarge()
+        stream = self.environ['wsgi.input']
+        if isinstance(stream, LimitedInput):
+            stream.limit = max_size
+        else:
+            self.environ['wsgi.input'] = LimitedInput(stream, max_size)
+        self.max_body_size = max_size
+
+    @cached_property
+    def json(self):
+        '''
+        Decoded body of request with "application/json" content type, None
+        for other requests. Raises `HTTPRequestEntityTooLarge` if body is
+        larger than `max_json_size` bytes and `HTTPBadRequest` if it is not
+        valid JSON.
+        '''
+        if self.content_type != 'application/json':
+            return None
+        max_size = self.max_json_size
+        if self.content_length is not None and self.content_length > max_size:
+            raise HTTPRequestEntityTooLarge()
+        if self.is_body_seekable:
+            self.body_file.seek(0)
+        body = self.body_file.read(max_size + 1)
+        if len(body) > max_size:
+            raise HTTPRequestEntityTooLarge()
+        try:
+            return json.loads(body, encoding=self.charset or 'utf-8')
+        except ValueError, e:
+            raise HTTPBadRequest('Invalid JSON: %s' % e)
 
     @property
-    def subdomain(self):
+    def headers_only(self):
+        '''True if only response headers are sent (HEAD request), so
+        handlers may skip making the body'''
+        return self.method == 'HEAD'
+
+    @cached_property
+    def _host_name(self):
         if self.headers.get('Host'):
             server_name = self.headers.get('Host').split(':')[0]
         else:
             server_name = self.server_name
-        path = server_name.decode('idna')
+        return server_name.decode('idna')
+
+    @property
+    def subdomain(self):
+        path = self._host_name
         if self._subdomain:
             path = path[:-len(self._subdomain)-1]
         return path
 
     @cached_property
     def FILES(self):
-        return self._sub_post(lambda x: isinstance(x[1], cgi.FieldStorage))
+        return self._parsed_post[1]
 
     @cached_property
     def POST(self):
-        return self._sub_post(lambda x: not isinstance(x[1], cgi.FieldStorage))
+        return self._parsed_post[0]
+
+    @cached_property
+    def _parsed_post(self):
+        '''POST and FILES made in one pass, multipart body is parsed by
+        `MultipartParser`'''
+        if self.method in ('POST', 'PUT') and \
+                self.content_type == 'multipart/form-data':
+            fields, files = self._parse_multipart()
+            # webob.Request.str_POST and params will use parsed data
+            self.environ['webob._parsed_post_vars'] = \
+                    (MultiDict(fields + files), self.body_file_raw)
+        else:
+            post = super(Request, self).str_POST
+            if isinstance(post, NoVars):
+                return post, post
+            fields, files = [], []
+            for item in post.items():
+                if isinstance(item[1], cgi.FieldStorage):
+                    files.append(item)
+                else:
+                    fields.append(item)
+        return self._unicode_multidict(fields), self._unicode_multidict(files)
 
-    def _sub_post(self, condition):
-        post = super(Request, self).str_POST
-        if isinstance(post, NoVars):
-            return post
-        return UnicodeMultiDict(MultiDict(filter(condition, post.items())),
+    def _unicode_multidict(self, items):
+        return UnicodeMultiDict(MultiDict(items),
                                 encoding=self.charset,
                                 errors=self.unicode_errors,
                                 decode_keys=self.decode_param_names)
+
+    def _parse_multipart(self):
+        ctype, options = cgi.parse_header(self.environ.get('CONTENT_TYPE', ''))
+        if not options.get('boundary'):
+            raise HTTPBadRequest('Multipart boundary is missing')
+        if self.is_body_seekable:
+            self.body_file_raw.seek(0)
+        content_length = self.content_length
+        if content_length is None and \
+                not self.environ.get('wsgi.input_terminated'):
+            content_length = 0
+        parser = MultipartParser(self.body_file_raw, options['boundary'],
+                                 content_length,
+                                 memory_limit=self.multipart_memory_limit,
+                                 part_limit=self.max_part_size,
+                                 total_limit=self.max_body_size)
+        try:
+            return parser.parse()
+        except MultipartLimitError, e:
+            raise HTTPRequestEntityTooLarge(str(e))
+        except MultipartError, e:
+            raise HTTPBadRequest(str(e))
+
+
+def json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class JSONResponse(Response):
+    '''
+    Response with `obj` serialized to JSON by `dumps` function (compact
+    `json.dumps` by default, `simplejson` is used if it is installed).
+    '''
+
+    default_content_type = 'application/json'
+
+    def __init__(self, obj, dumps=json_dumps, **kwargs):
+        super(JSONResponse, self).__init__(body=dumps(obj), **kwargs)
+
+
+class LimitedInput(object):
+    '''
+    Wrapper of "wsgi.input" raising `HTTPRequestEntityTooLarge` when more
+    than `limit` bytes are read.
+    '''
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.bytes_read = 0
+
+    def _count(self, data):
+        self.bytes_read += len(data)
+        if self.bytes_read > self.limit:
+            raise HTTPRequestEntityTooLarge()
+        return data
+
+    def read(self, *args):
+        return self._count(self.stream.read(*args))
+
+    def readline(self, *args):
+        return self._count(self.stream.readline(*args))
+
+    def readlines(self, *args):
+        return [self._count(line) for line in self.stream.readlines(*args)]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration()
+        return line
+
+    def seek(self, *args):
+        self.stream.seek(*args)
+        self.bytes_read = self.stream.tell()
+
+    def tell(self):
+        return self.stream.tell()
+
+
+class FileIter(object):
+    '''
+    Iterates over file in chunks of `block_size` bytes, reading at most
+    `length` bytes if it is given. Used as `Response.app_iter` to stream
+    files; WSGI application passes it to `wsgi.file_wrapper` if server
+    provides one.
+    '''
+
+    block_size = 64 * 1024
+
+    def __init__(self, file, block_size=None, length=None):
+        self.file = file
+        if block_size is not None:
+            self.block_size = block_size
+        self.length = length
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        size = self.block_size
+        if self.length is not None:
+            size = min(size, self.length)
+            if not size:
+                raise StopIteration()
+        chunk = self.file.read(size)
+        if not chunk:
+            raise StopIteration()
+        if self.length is not None:
+            self.length -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.file.close()
+
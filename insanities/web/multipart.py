@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['MultipartParser', 'MultipartFile', 'MultipartError',
+           'MultipartLimitError']
+
+import cgi
+from tempfile import SpooledTemporaryFile
+from StringIO import StringIO
+
+
+class MultipartError(ValueError):
+    '''Malformed multipart body'''
+
+
+class MultipartLimitError(MultipartError):
+    '''Multipart body or its part exceeds size limit'''
+
+
+class MultipartFile(cgi.FieldStorage):
+    '''
+    Uploaded file. It is `cgi.FieldStorage` (only `name`, `filename`,
+    `type`, `headers`, `file` and `value` are set), so code expecting
+    webob file fields works unchanged.
+    '''
+
+    def __init__(self, name, filename, headers, file):
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.type, self.type_options = cgi.parse_header(
+                headers.get('content-type', 'application/octet-stream'))
+        self.disposition = 'form-data'
+        self.file = file
+        self.list = None
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+
+class MultipartParser(object):
+    '''
+    Parses "multipart/form-data" body reading it from `stream` in chunks
+    of `block_size` bytes. Files are spooled to temporary files when they
+    get larger than `memory_limit` bytes.
+
+    content_length - size of the body, if None stream is read until the
+                     end (for servers providing terminated "wsgi.input").
+    part_limit - maximum size of a part in bytes, unlimited if None.
+    total_limit - maximum size of the body in bytes, unlimited if None.
+    '''
+
+    block_size = 64 * 1024
+    # maximum size of headers of a part
+    max_headers_size = 8 * 1024
+
+    def __init__(self, stream, boundary, content_length, memory_limit=1024*1024,
+                 part_limit=None, total_limit=None, block_size=None):
+        self.stream = stream
+        self.boundary = boundary
+        self.content_length = content_length
+        self.memory_limit = memory_limit
+        self.part_limit = part_limit
+        self.total_limit = total_limit
+        if block_size is not None:
+            self.block_size = block_size
+
+    def _chunks(self):
+        remaining = self.content_length
+        if remaining is None:
+            total = 0
+            while True:
+                chunk = self.stream.read(self.block_size)
+                if not chunk:
+                    return
+                total += len(chunk)
+                if self.total_limit is not None and total > self.total_limit:
+                    raise MultipartLimitError('Request body is too large')
+                yield chunk
+        if self.total_limit is not None and remaining > self.total_limit:
+            raise MultipartLimitError('Request body is too large')
+        while remaining > 0:
+            chunk = self.stream.read(min(self.block_size, remaining))
+            if not chunk:
+                raise MultipartError('Unexpected end of request body')
+            remaining -= len(chunk)
+            yield chunk
+
+    def parse(self):
+        '''Returns lists of (name, value) pairs of fields and
+        (name, `MultipartFile`) pairs of files'''
+        fields = []
+        files = []
+        chunks = self._chunks()
+        # buffer is kept in a list to be changed in nested function
+        state = ['']
+
+        def fill():
+            for chunk in chunks:
+                state[0] += chunk
+                return True
+            return False
+
+        def read_until(separator, limit):
+            while True:
+                index = state[0].find(separator)
+                if index >= 0:
+                    result = state[0][:index]
+                    state[0] = state[0][index+len(separator):]
+                    return result
+                if len(state[0]) > limit:
+                    raise MultipartLimitError('Multipart headers are too large')
+                if not fill():
+                    raise MultipartError('Unexpected end of request body')
+
+        delimiter = '--' + self.boundary
+        # preamble is ignored
+        read_until(delimiter, self.max_headers_size)
+        while True:
+            while len(state[0]) < 2 and fill():
+                pass
+            if state[0][:2] == '--':
+                break
+            # the rest of delimiter line
+            read_until('\r\n', self.max_headers_size)
+            headers = self._parse_headers(
+                    read_until('\r\n\r\n', self.max_headers_size))
+            disposition, options = cgi.parse_header(
+                    headers.get('content-disposition', ''))
+            name = options.get('name')
+            filename = options.get('filename')
+            if name is None:
+                raise MultipartError('Multipart part has no name')
+            if filename is None:
+                sink = StringIO()
+            else:
+                sink = SpooledTemporaryFile(max_size=self.memory_limit)
+            self._read_part(state, fill, '\r\n' + delimiter, sink)
+            if filename is None:
+                fields.append((name, sink.getvalue()))
+            else:
+                sink.seek(0)
+                files.append((name, MultipartFile(name, filename, headers,
+                                                  sink)))
+        return fields, files
+
+    def _read_part(self, state, fill, delimiter, sink):
+        size = 0
+        # tail of buffer which may be the beginning of delimiter
+        keep = len(delimiter) - 1
+        while True:
+            buf = state[0]
+            index = buf.find(delimiter)
+            if index >= 0:
+                data, state[0] = buf[:index], buf[index+len(delimiter):]
+            elif len(buf) > keep:
+                data, state[0] = buf[:-keep], buf[-keep:]
+            else:
+                data = ''
+            size += len(data)
+            if self.part_limit is not None and size > self.part_limit:
+                raise MultipartLimitError('Multipart part is too large')
+            sink.write(data)
+            if index >= 0:
+                return
+            if not fill():
+                raise MultipartError('Unexpected end of request body')
+
+    def _parse_headers(self, data):
+        headers = {}
+        for line in data.split('\r\n'):
+            if not line:
+                continue
+            if ':' not in line:
+                raise MultipartError('Malformed multipart header')
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        return headers
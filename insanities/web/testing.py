@@ -11,5 +11,7 @@ def ask(application, url, method='get', data=None,
     env = VersionedStorage(additional_env or {})
     #TODO: may be later process cookies separatly
     env.request = Request.blank(url, POST=data, headers=headers)
+    if method.lower() != 'get':
+        env.request.method = method.upper()
     data = VersionedStorage(additional_data or {})
     return application(env, data)
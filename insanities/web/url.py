@@ -36,11 +36,14 @@ class URL(str):
         '''
         path = path if isinstance(path, str) else urlquote(path)
         query = MultiDict(query) if query else MultiDict()
-        host = host or ''
-        port = port or ''
-        scheme = scheme or 'http'
-        self = str.__new__(cls, construct_url(path, query, host, 
-                                              port,scheme))
+        return cls._from_parts(path, query, host or '', port or '',
+                               scheme or 'http')
+
+    @classmethod
+    def _from_parts(cls, path, query, host, port, scheme):
+        '''Makes URL of prepared parts, `query` MultiDict is not copied'''
+        self = str.__new__(cls, construct_url(path, query, host,
+                                              port, scheme))
         self.path = path
         self.query = query
         self.host = host
@@ -48,46 +51,45 @@ class URL(str):
         self.scheme = scheme
         return self
 
-    def _copy(self, **kwargs):
-        path = kwargs.pop('path', self.path)
-        kw = dict(query=self.query, host=self.host, 
-                  port=self.port, scheme=self.scheme)
-        kw.update(kwargs)
-        return self.__class__(path, **kw)
+    def update(self, set=None, add=None, delete=None):
+        '''
+        Returns URL with several changes of query made at once (query is
+        copied and URL is built once): keys from `delete` are deleted,
+        values from `set` replace values of their keys, values from `add`
+        are added. `set` and `add` are mappings or lists of pairs.
+
+            url.update(set={'page': 2}, add=[('tag', 'a')], delete=['q'])
+        '''
+        query = self.query.copy()
+        for key in delete or ():
+            del query[key]
+        if set:
+            set = MultiDict(set)
+            for key in set.keys():
+                if key in query:
+                    del query[key]
+            for key, value in set.items():
+                query.add(key, value)
+        if add:
+            for key, value in MultiDict(add).items():
+                query.add(key, value)
+        return self._from_parts(self.path, query, self.host, self.port,
+                                self.scheme)
 
     def set(self, *args, **kwargs):
         '''Sets value of URL's query keys to given values'''
         if args and kwargs:
             raise TypeError('Use positional args or keyword args not both')
-        query = self.query.copy()
-        if args:
-            mdict = MultiDict(args[0])
-            for k in mdict.keys():
-                if k in query:
-                    del query[k]
-            for k, v in mdict.items():
-                query.add(k, v)
-        else:
-            for k, v in kwargs.items():
-                query[k] = v
-        return self._copy(query=query)
+        return self.update(set=args[0] if args else kwargs)
 
     def add(self, *args, **kwargs):
         '''Adds values to URL's query'''
-        query = self.query.copy()
-        if args:
-            mdict = MultiDict(args[0])
-            for k, v in mdict.items():
-                query.add(k, v)
-        for k, v in kwargs.items():
-            query.add(k, v)
-        return self._copy(query=query)
+        values = MultiDict(args[0]).items() if args else []
+        return self.update(add=values + kwargs.items())
 
     def delete(self, key):
         '''Deletes given key from the URL's query'''
-        query = self.query.copy()
-        del query[key]
-        return self._copy(query=query)
+        return self.update(delete=[key])
 
     def getall(self, key):
         '''A proxy method for query.getall'''
@@ -134,6 +136,10 @@ class Converter(object):
     #: A key significating what converter is used in particular url template
     name=None
 
+    #: Whether `to_python` result depends on keyword arguments (`env`), so
+    #: match results of templates using the converter can't be cached
+    depends_on_env=True
+
     def to_python(self, value, **kwargs):
         '''
         Accepts unicode url part and returns python object.
@@ -158,6 +164,7 @@ class String(Converter):
     '''
 
     name='string'
+    depends_on_env=False
 
     def to_python(self, value, **kwargs):
         return value
@@ -174,6 +181,7 @@ class Integer(Converter):
     '''
 
     name='int'
+    depends_on_env=False
 
     def to_python(self, value, **kwargs):
         try:
@@ -195,6 +203,7 @@ class Boolean(Converter):
     '''
 
     name='bool'
+    depends_on_env=False
     _true = ['on', 'true', 'True', 'yes']
     _false = ['off', 'false', 'False', 'no']
 
@@ -213,6 +222,7 @@ class Boolean(Converter):
 
 class Any(Converter):
     name='any'
+    depends_on_env=False
     def __init__(self, *values):
         self.values = values
 
@@ -313,11 +323,37 @@ class UrlTemplate(object):
                                                                              match_whole_str=match_whole_str,
                                                                              converters=self._allowed_converters,
                                                                              default_converter=default_converter)
+        # leading part of the template without url params (urlencoded str),
+        # every path matched by this template starts with it
+        self._static_prefix = ''
+        for part in self._builder_params:
+            if isinstance(part, tuple):
+                break
+            self._static_prefix += part
+        # template without url params is matched without regex
+        self._is_static = not self._url_params
+        # match results depend on path only and can be cached
+        self._cacheable = not [c for c in self._url_params.values()
+                               if c.depends_on_env]
+        # format string and (variable name, converter) for each %s in it,
+        # used for url building
+        self._format = ''
+        self._format_params = []
+        for part in self._builder_params:
+            if isinstance(part, tuple):
+                self._format += '%s'
+                self._format_params.append(part)
+            else:
+                self._format += part.replace('%', '%%')
 
     def match(self, path, **kw):
         '''
         path - str (urlencoded)
         '''
+        if self._is_static:
+            if self.match_whole_str:
+                return path == self._static_prefix, {}
+            return path.startswith(self._static_prefix), {}
         m = self._pattern.match(path)
         if m:
             kwargs = m.groupdict()
@@ -335,16 +371,11 @@ class UrlTemplate(object):
 
     def __call__(self, **kwargs):
         'Url building with url params values taken from kwargs. (reverse)'
-        result = ''
-        for part in self._builder_params:
-            if isinstance(part, tuple):
-                var, conv_obj = part
-                value = kwargs[var]
-                result += urlquote(conv_obj.to_url(value))
-            else:
-                result += part
+        if self._is_static:
+            return self._static_prefix
         # result - urlencoded str
-        return result
+        return self._format % tuple([urlquote(conv_obj.to_url(kwargs[var]))
+                                     for var, conv_obj in self._format_params])
 
     def _init_converters(self, converters):
         convs = convs_dict.copy()
@@ -358,3 +389,76 @@ class UrlTemplate(object):
         return '%s(%r, match_whole_str=%r)' % (self.__class__.__name__, 
                                                self.template.encode('utf-8'),
                                                self.match_whole_str)
+
+
+class UrlBuilder(object):
+    '''
+    Builds url path from several url templates (prefixes and match) at once
+    with one format string.
+    '''
+
+    def __init__(self, templates):
+        self._format = ''.join([t._format for t in templates])
+        self._params = []
+        for template in templates:
+            self._params.extend(template._format_params)
+
+    def __call__(self, **kwargs):
+        if not self._params:
+            return self._format % ()
+        # result - urlencoded str
+        return self._format % tuple([urlquote(conv_obj.to_url(kwargs[var]))
+                                     for var, conv_obj in self._params])
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._format)
+
+
+_named_group_pattern = re.compile(r'\(\?P<[a-zA-Z_][a-zA-Z0-9_]*>')
+
+# python's re module does not support more groups in one pattern
+_max_groups = 99
+
+
+class UrlTemplateSet(object):
+    '''
+    Matches a path against several url templates at once. Templates are
+    merged into alternations of tagged groups, so one `re.match` call per
+    chunk of templates finds the first matching template.
+
+    Converters are not applied, so the matched template still may reject
+    the path.
+    '''
+
+    def __init__(self, templates):
+        '''
+        templates - list of (tag, UrlTemplate)
+        '''
+        self._tags = {}
+        self._patterns = []
+        templates = list(templates)
+        for start in xrange(0, len(templates), _max_groups):
+            alternatives = []
+            for i, (tag, template) in enumerate(templates[start:start+_max_groups]):
+                group = '_t%d' % (start + i)
+                self._tags[group] = tag
+                # leading "^" is dropped, named groups become non-capturing
+                source = _named_group_pattern.sub('(?:', template._pattern.pattern[1:])
+                alternatives.append('(?P<%s>%s)' % (group, source))
+            self._patterns.append(re.compile('|'.join(alternatives)))
+
+    def first_match(self, path):
+        '''
+        path - str (urlencoded)
+
+        returns tag of the first template matching the path or None
+        '''
+        for pattern in self._patterns:
+            m = pattern.match(path)
+            if m:
+                return self._tags[m.lastgroup]
+        return None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, sorted(self._tags.values()))
+
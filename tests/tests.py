@@ -9,6 +9,7 @@ import unittest
 from unittest import defaultTestLoader as dtl
 
 from utils.storage import *
+from utils.lru import *
 from utils.html import *
 from utils.url import *
 
@@ -16,6 +17,8 @@ from web.chain import *
 from web.reverse import *
 from web.convs import *
 from web.filter import *
+from web.http import *
+from web.cache import *
 
 from forms.convs import *
 from forms.fields import *
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['LRUCacheTests']
+
+import unittest
+from insanities.utils.lru import LRUCache
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_get_set(self):
+        'LRUCache get and set'
+        c = LRUCache(2)
+        c['a'] = 1
+        self.assertEqual(c['a'], 1)
+        self.assertEqual(c.get('b'), None)
+        self.assertRaises(KeyError, lambda: c['b'])
+        c['a'] = 2
+        self.assertEqual(c.get('a'), 2)
+        self.assertEqual(len(c), 1)
+
+    def test_eviction(self):
+        'LRUCache evicts least recently used items'
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        c.get('a')
+        c['c'] = 3
+        self.assert_('a' in c)
+        self.assert_('b' not in c)
+        self.assert_('c' in c)
+        self.assertEqual(len(c), 2)
+
+    def test_delete(self):
+        'LRUCache delete, pop and clear'
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        del c['a']
+        self.assert_('a' not in c)
+        self.assertEqual(c.pop('b'), 2)
+        self.assertEqual(c.pop('b'), None)
+        c['a'] = 1
+        c.clear()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.get('a'), None)
+
+    def test_getsize(self):
+        'LRUCache limited by total size of values'
+        c = LRUCache(5, getsize=len)
+        c['a'] = 'aa'
+        c['b'] = 'bb'
+        self.assertEqual(c.size, 4)
+        c['a'] = 'aaa'
+        self.assertEqual(c.size, 5)
+        c['c'] = 'c'
+        self.assert_('b' not in c)
+        self.assertEqual(c.size, 4)
+        c['d'] = 'dddddd'
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.size, 0)
+
@@ -34,22 +34,27 @@ class VersionedStorageTests(unittest.TestCase):
         d['a'] = 1
         d._commit()
         self.assert_(not d._modified)
-        self.assertEqual(d._VersionedStorage__stack, [{}, {'a': 1}], 'Incorrect stack state')
         self.assertEqual(d['a'] , 1)
         self.assertRaises(KeyError, lambda: d['b'])
 
         # second commit do nothing
         d._commit()
         self.assert_(not d._modified)
-        self.assertEqual(d._VersionedStorage__stack, [{}, {'a': 1}])
         self.assertEqual(d.as_dict(), {'a': 1})
         self.assertRaises(KeyError, lambda: d['b'])
 
+        # so one rollback restores committed state, the next one does nothing
+        d['b'] = 2
+        d._rollback()
+        self.assertEqual(d.as_dict(), {'a': 1})
+        d._rollback()
+        self.assertEqual(d.as_dict(), {'a': 1})
+
     def test_rollback_empty(self):
         'VersionedStorage "rollback" method on empty dict'
         d = VersionedStorage()
         d._rollback()
-        self.assertEqual(d._VersionedStorage__stack, [{}])
+        self.assertEqual(d.as_dict(), {})
         self.assert_(not d._modified)
 
     def test_rollback(self):
@@ -61,7 +66,9 @@ class VersionedStorageTests(unittest.TestCase):
         self.assertEqual(d.as_dict(), {'a': 1, 'b': 2})
         d._rollback()
         self.assertEqual(d.as_dict(), {'a': 1})
-        self.assertEqual(d._VersionedStorage__stack, [{}])
+        # there is nothing more to roll back
+        d._rollback()
+        self.assertEqual(d.as_dict(), {'a': 1})
 
     def test_getattr(self):
         'VersionedStorage getattr method'
@@ -93,3 +100,36 @@ class VersionedStorageTests(unittest.TestCase):
         self.assert_('a' in d)
         self.assert_('b' in d)
         self.assert_('c' in d)
+
+    def test_rollback_changes(self):
+        'VersionedStorage "rollback" restores changed and deleted values'
+        d = VersionedStorage(a=1, b=2)
+        d._commit()
+        d.a = 3
+        d.a = 4
+        del d['b']
+        d.c = 5
+        self.assert_(d._modified)
+        d._rollback()
+        self.assertEqual(d.as_dict(), {'a': 1, 'b': 2})
+
+    def test_mark_sweep(self):
+        'VersionedStorage "mark" and "sweep" methods'
+        d = VersionedStorage(a=1)
+        mark = d._mark()
+        d.b = 2
+        d._commit()
+        inner_mark = d._mark()
+        del d.a
+        d._sweep(inner_mark)
+        self.assertEqual(d.as_dict(), {'a': 1, 'b': 2})
+        d._sweep(mark)
+        self.assertEqual(d.as_dict(), {'a': 1})
+
+    def test_missing_keys(self):
+        'VersionedStorage deleting missing keys'
+        d = VersionedStorage()
+        self.assertRaises(KeyError, lambda: d.__delitem__('a'))
+        self.assertRaises(AttributeError, lambda: delattr(d, 'a'))
+        self.assert_(not d._modified)
+
@@ -2,7 +2,8 @@
 
 import unittest
 from urllib import quote
-from insanities.web.url import URL, UrlTemplate, Converter, ConvertError
+from insanities.web.url import URL, UrlTemplate, UrlTemplateSet, UrlBuilder, \
+                                Converter, ConvertError
 
 
 class URLTests(unittest.TestCase):
@@ -26,6 +27,19 @@ class URLTests(unittest.TestCase):
         u = u.set(page=7, title='land')
         self.assertEqual(u, '/path/to/something?id=3&page=7&title=land')
 
+    def test_update(self):
+        'Several changes of url params at once'
+        u = URL('/path', query=[('id', 3), ('tag', 'a'), ('q', 'x')])
+        self.assertEqual(u.update(set={'id': 4}, add=[('tag', 'b')], delete=['q']),
+                         '/path?tag=a&id=4&tag=b')
+        self.assertEqual(u, '/path?id=3&tag=a&q=x')
+        self.assertEqual(u.update(set=[('tag', 'c'), ('tag', 'd')]),
+                         '/path?id=3&q=x&tag=c&tag=d')
+        self.assertEqual(u.update(), u)
+        self.assertRaises(KeyError, u.update, delete=['missing'])
+        self.assertEqual(u.add(tag='b').getall('tag'), ['a', 'b'])
+        self.assertEqual(u.delete('tag'), '/path?id=3&q=x')
+
     def test_param_get(self):
         'Get param from url'
         u = URL('/path/to/something', query=dict(id=3, page=5, title='title'))
@@ -132,3 +146,44 @@ class UrlTemplateTest(unittest.TestCase):
         'Unknown converter'
         self.assertRaises(KeyError, lambda: UrlTemplate('/<baba:name>/'))
         self.assertRaises(KeyError, lambda: UrlTemplate('/<baba:name></'))
+
+
+class UrlTemplateSetTest(unittest.TestCase):
+
+    def test_first_match(self):
+        'First matching template of the set'
+        ts = UrlTemplateSet([
+            ('a', UrlTemplate('/<int:id>')),
+            ('b', UrlTemplate('/<name>')),
+            ('c', UrlTemplate('/docs/<name>/edit'))])
+        self.assertEqual(ts.first_match('/1'), 'a')
+        self.assertEqual(ts.first_match('/docs'), 'a')
+        self.assertEqual(ts.first_match('/docs/1/edit'), 'c')
+        self.assertEqual(ts.first_match('/docs/1'), None)
+
+    def test_many_templates(self):
+        'Set of templates with more groups than one pattern supports'
+        ts = UrlTemplateSet([(i, UrlTemplate('/%d/<name>' % i))
+                             for i in range(250)])
+        self.assertEqual(ts.first_match('/0/x'), 0)
+        self.assertEqual(ts.first_match('/249/x'), 249)
+        self.assertEqual(ts.first_match('/250/x'), None)
+
+
+class UrlBuilderTest(unittest.TestCase):
+
+    def test_build(self):
+        'Building path from several templates'
+        b = UrlBuilder([UrlTemplate(u'/%/<int:id>', match_whole_str=False),
+                        UrlTemplate('/'),
+                        UrlTemplate(u'<name>/<int:page>')])
+        self.assertEqual(b(id=1, name=u'д', page=2), '/%25/1/%D0%B4/2')
+        self.assertRaises(KeyError, lambda: b(id=1))
+
+    def test_static(self):
+        'Building path from templates without params'
+        b = UrlBuilder([UrlTemplate(u'/%', match_whole_str=False),
+                        UrlTemplate('/')])
+        self.assertEqual(b(), '/%25/')
+        self.assertEqual(UrlTemplate(u'/%')(), '/%25')
+
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['CacheResponse']
+
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from insanities import web
+from insanities.web.http import Response
+
+
+class CacheResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def page(self, env, data, nh):
+        self.calls.append(env.request.path_qs)
+        return Response('page %d' % len(self.calls))
+
+    def test_memory(self):
+        '''Responses cached in memory'''
+        app = web.cache_response(60) | self.page
+        self.assertEqual(web.ask(app, '/').body, 'page 1')
+        response = web.ask(app, '/')
+        self.assertEqual(response.body, 'page 1')
+        self.assertEqual(response.content_type, 'text/html')
+        self.assertEqual(web.ask(app, '/?page=2').body, 'page 2')
+        self.assertEqual(self.calls, ['/', '/?page=2'])
+        self.assertEqual(web.ask(app, '/', method='POST').body, 'page 3')
+
+    def test_head(self):
+        '''Response to HEAD request is not cached'''
+        def page(env, data, nh):
+            self.calls.append(env.request.method)
+            if env.request.headers_only:
+                return Response(content_length=4)
+            return Response('page')
+        app = web.cache_response(60) | page
+        self.assertEqual(web.ask(app, '/', method='HEAD').body, '')
+        self.assertEqual(web.ask(app, '/').body, 'page')
+        self.assertEqual(web.ask(app, '/', method='HEAD').content_length, 4)
+        self.assertEqual(self.calls, ['HEAD', 'GET'])
+
+    def test_key(self):
+        '''Cache key and vary headers'''
+        def key(env, data):
+            if 'Cookie' not in env.request.headers:
+                return env.request.path
+        app = web.cache_response(60, key=key, vary=['Accept-Language']) | \
+                self.page
+        self.assertEqual(web.ask(app, '/?a').body, 'page 1')
+        self.assertEqual(web.ask(app, '/?b').body, 'page 1')
+        self.assertEqual(web.ask(app, '/', headers={'Accept-Language': 'ru'})
+                         .body, 'page 2')
+        self.assertEqual(web.ask(app, '/', headers={'Cookie': 'sid=1'}).body,
+                         'page 3')
+        self.assertEqual(web.ask(app, '/', headers={'Cookie': 'sid=1'}).body,
+                         'page 4')
+
+    def test_host(self):
+        '''Responses for different hosts are cached separately'''
+        app = web.cache_response(60) | web.subdomain('host') | web.cases(
+            web.subdomain('en') | web.match('/about', 'about') | self.page,
+            web.subdomain('ru') | web.match('/about', 'about') | self.page)
+        self.assertEqual(web.ask(app, 'http://en.host/about').body, 'page 1')
+        self.assertEqual(web.ask(app, 'http://ru.host/about').body, 'page 2')
+        self.assertEqual(web.ask(app, 'http://en.host/about').body, 'page 1')
+
+    def test_vary(self):
+        '''Responses varying on headers missing in the key are not cached'''
+        body = 'page ' * 200
+        def page(env, data, nh):
+            self.calls.append(1)
+            return Response(body)
+        app = web.cache_response(60) | web.compress() | page
+        response = web.ask(app, '/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(web.ask(app, '/').body, body)
+        self.assertEqual(len(self.calls), 2)
+        app = web.cache_response(60, vary=['Accept-Encoding']) | \
+                web.compress() | page
+        for i in range(2):
+            response = web.ask(app, '/', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(web.ask(app, '/').body, body)
+        self.assertEqual(len(self.calls), 4)
+
+    def test_cache_control(self):
+        '''Private responses are not cached'''
+        for value in ('private', 'no-store', 'max-age=0, private="Set-Cookie"'):
+            def page(env, data, nh):
+                self.calls.append(1)
+                return Response(cache_control=value)
+            app = web.cache_response(60) | page
+            web.ask(app, '/')
+            web.ask(app, '/')
+        self.assertEqual(len(self.calls), 6)
+
+    def test_not_cached(self):
+        '''Responses which are not cached'''
+        def handler(env, data, nh):
+            self.calls.append(1)
+            response = Response()
+            response.set_cookie('sid', '1')
+            return response
+        app = web.cache_response(60) | handler
+        web.ask(app, '/')
+        web.ask(app, '/')
+        self.assertEqual(len(self.calls), 2)
+        app = web.cache_response(60) | (lambda e, d, n: None)
+        self.assert_(web.ask(app, '/') is None)
+
+    def test_expired(self):
+        '''Expired response is made by one request'''
+        app = web.cache_response(0) | self.page
+        self.assertEqual(web.ask(app, '/').body, 'page 1')
+        started = threading.Event()
+        release = threading.Event()
+        def slow(env, data, nh):
+            started.set()
+            release.wait()
+            return self.page(env, data, nh)
+        app._next_handler = web.handler(slow)
+        thread = threading.Thread(target=web.ask, args=(app, '/'))
+        thread.start()
+        started.wait()
+        # expired response is returned while the new one is made
+        self.assertEqual(web.ask(app, '/').body, 'page 1')
+        release.set()
+        thread.join()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_uncacheable(self):
+        '''Requests for uncacheable response don't wait for each other'''
+        release = threading.Event()
+        waited = []
+        def page(env, data, nh):
+            self.calls.append(1)
+            if len(self.calls) == 2:
+                waited.append(release.wait(5))
+            elif len(self.calls) == 3:
+                release.set()
+            response = Response()
+            response.set_cookie('sid', '1')
+            return response
+        app = web.cache_response(60) | page
+        web.ask(app, '/')
+        thread = threading.Thread(target=web.ask, args=(app, '/'))
+        thread.start()
+        while len(self.calls) < 2:
+            time.sleep(0.001)
+        web.ask(app, '/')
+        thread.join()
+        self.assertEqual(waited, [True])
+
+    def test_lock_timeout(self):
+        '''Waiting for response made by other request is limited'''
+        release = threading.Event()
+        def page(env, data, nh):
+            self.calls.append(1)
+            number = len(self.calls)
+            if number == 1:
+                release.wait(5)
+            return Response('page %d' % number)
+        app = web.cache_response(60, lock_timeout=0.01) | page
+        thread = threading.Thread(target=web.ask, args=(app, '/'))
+        thread.start()
+        while not self.calls:
+            time.sleep(0.001)
+        self.assertEqual(web.ask(app, '/').body, 'page 2')
+        release.set()
+        thread.join()
+        self.assertEqual(web.ask(app, '/').body, 'page 1')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_file(self):
+        '''Responses cached in files'''
+        directory = tempfile.mkdtemp()
+        try:
+            backend = web.FileCache(directory)
+            app = web.cache_response(60, backend=backend) | self.page
+            self.assertEqual(web.ask(app, '/').body, 'page 1')
+            app = web.cache_response(60, backend=web.FileCache(directory)) | \
+                    self.page
+            self.assertEqual(web.ask(app, '/').body, 'page 1')
+            self.assertEqual(len(self.calls), 1)
+        finally:
+            shutil.rmtree(directory)
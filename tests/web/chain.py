@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['Chain']
+__all__ = ['Chain', 'CompiledChain', 'PureHandlers', 'Offload']
 
+import time
+import threading
 import unittest
+from StringIO import StringIO
 from insanities import web
+from insanities.web.http import Response
 from insanities.utils.storage import VersionedStorage
+from multiprocessing.pool import ThreadPool
 
 
 class Chain(unittest.TestCase):
@@ -144,3 +149,283 @@ class Chain(unittest.TestCase):
 
         chain = web.cases(h) | web.cases(h1, h1)
         chain(VersionedStorage(), VersionedStorage())
+
+
+class CompiledChain(unittest.TestCase):
+
+    def test_flat(self):
+        '''Filters of compiled chain are called in a loop'''
+        def handler(env, data, nh):
+            self.assertEqual(env.namespace, 'a.b')
+            self.assertEqual(data.id, 1)
+            return Response()
+
+        chain = web.namespace('a') | web.match('/<int:id>', 'item') | \
+                web.namespace('b') | handler
+        compiled = chain.compile()
+        self.assert_(isinstance(compiled, web.FlatChain))
+        self.assertEqual(len(compiled.handlers), 4)
+        self.assertEqual(web.ask(compiled, '/1').status_int, 200)
+        self.assertEqual(web.locations(compiled).keys(), ['a.item'])
+
+    def test_filter_handle(self):
+        '''Filter subclass overriding handle in compiled chain'''
+        class logged_match(web.match):
+            def handle(self, env, data, next_handler):
+                data.logged = True
+                return web.match.handle(self, env, data, next_handler)
+
+        chain = logged_match('/', 'index') | \
+                (lambda e, d, n: Response(str(d.logged)))
+        self.assertEqual(web.ask(chain, '/').body, 'True')
+        compiled = chain.compile()
+        self.assertEqual(web.ask(compiled, '/').body, 'True')
+        self.assertEqual(web.ask(compiled, '/a'), None)
+
+    def test_rollback(self):
+        '''Compiled chain rolls back env and data'''
+        def handler(env, data, nh):
+            data.count += 1
+            return nh(env, data)
+
+        chain = web.handler(handler) | web.match('/', 'index') | handler
+        env = VersionedStorage(request=web.Request.blank('/a'))
+        data = VersionedStorage(count=0)
+        self.assert_(chain.compile()(env, data) is None)
+        self.assertEqual(data.as_dict(), {'count': 0})
+        self.assert_('current_url_name' not in env)
+
+    def test_wrapper(self):
+        '''Handlers wrapping next handler in compiled chain'''
+        def wrapper(env, data, nh):
+            env.user = 'user'
+            try:
+                result = nh(env, data)
+            finally:
+                del env.user
+            self.assert_('namespace' not in env)
+            return result
+
+        def handler(env, data, nh):
+            self.assertEqual(env.user, 'user')
+            return nh(env, data)
+
+        chain = web.handler(wrapper) | web.namespace('a') | web.method('POST') | handler
+        env = VersionedStorage(request=web.Request.blank('/'))
+        self.assert_(chain.compile()(env, VersionedStorage()) is None)
+        self.assertEqual(env.as_dict().keys(), ['request'])
+
+    def test_cases(self):
+        '''Compiled cases branches'''
+        chain = web.prefix('/docs') | web.cases(
+            web.match('/', 'index') | (lambda e, d, n: Response(body='index')),
+            web.match('/<int:id>', 'doc') | web.methods(
+                get=lambda e, d, n: Response(body='get'),
+                post=web.namespace('post') | (lambda e, d, n: Response(body=e.namespace))),
+            compiled=True)
+        compiled = chain.compile()
+        self.assert_(isinstance(compiled.handlers[-1].handlers[1], web.FlatChain))
+        self.assertEqual(web.ask(compiled, '/docs/').body, 'index')
+        self.assertEqual(web.ask(compiled, '/docs/1').body, 'get')
+        self.assertEqual(web.ask(compiled, '/docs/1', data={'a': '1'}).body, 'post')
+        self.assert_(web.ask(compiled, '/docs/a') is None)
+        self.assertEqual(sorted(web.locations(compiled).keys()), ['doc', 'index'])
+
+
+class PureHandlers(unittest.TestCase):
+
+    def tearDown(self):
+        web.WebHandler.debug_pure = False
+
+    def test_no_rollback(self):
+        '''Changes of pure handlers are not rolled back'''
+        @web.pure
+        def handler(env, data, nh):
+            data.count += 1
+
+        data = VersionedStorage(count=0)
+        self.assert_(handler.pure)
+        self.assert_(handler(VersionedStorage(), data) is None)
+        self.assertEqual(data.count, 1)
+        self.assert_(handler.compile()(VersionedStorage(), data) is None)
+        self.assertEqual(data.count, 2)
+
+    def test_chain(self):
+        '''Pure handlers in chains'''
+        def handler(env, data, nh):
+            data.count += 1
+            return nh(env, data)
+
+        chain = web.method('GET') | web.pure(lambda e, d, n: n(e, d)) | handler
+        for app in (chain, chain.compile()):
+            data = VersionedStorage(count=0)
+            self.assert_(app(VersionedStorage(request=web.Request.blank('/')),
+                             data) is None)
+            self.assertEqual(data.count, 0)
+
+    def test_debug(self):
+        '''Pure handlers changing env or data in debug mode'''
+        web.WebHandler.debug_pure = True
+
+        def handler(env, data, nh):
+            data.count = 1
+            return nh(env, data)
+
+        chain = web.pure(handler) | (lambda e, d, n: None)
+        self.assertRaises(AssertionError,
+                          lambda: chain(VersionedStorage(), VersionedStorage()))
+        self.assertRaises(AssertionError,
+                          lambda: chain.compile()(VersionedStorage(), VersionedStorage()))
+
+        chain = web.method('GET') | handler
+        self.assert_(web.ask(chain, '/') is None)
+        self.assert_(web.ask(chain.compile(), '/') is None)
+
+        @web.pure
+        def responding(env, data, nh):
+            data.count = 1
+            return Response()
+        for app in (responding, web.method('GET') | responding):
+            self.assertRaises(AssertionError, lambda: web.ask(app, '/'))
+            self.assertRaises(AssertionError,
+                              lambda: web.ask(app.compile(), '/'))
+
+        # changes of nested chains are not checked
+        app = web.cases(web.match('/', 'index') | handler |
+                        (lambda e, d, n: Response()))
+        for app in (app, app.compile()):
+            self.assertEqual(web.ask(app, '/').status_int, 200)
+
+
+class Offload(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def blocking(self, env, data, nh):
+        self.release.wait()
+        data.thread = threading.current_thread()
+        return nh(env, data)
+
+    def test_offload(self):
+        '''Handler is run in thread pool'''
+        self.release.set()
+        app = web.offload(self.blocking, pool=2) | (lambda e, d, n: Response())
+        for app in (app, app.compile()):
+            data = VersionedStorage()
+            self.assert_(isinstance(app(VersionedStorage(), data), Response))
+            self.assertNotEqual(data.thread, threading.current_thread())
+        app = web.offload(self.blocking, pool=2)
+        data = VersionedStorage(count=0)
+        self.assert_(app(VersionedStorage(), data) is None)
+        self.assert_('thread' not in data)
+
+    def test_timeout(self):
+        '''Offloaded handler timeout'''
+        app = web.offload(self.blocking, pool=1, timeout=0.01)
+        response = app(VersionedStorage(), VersionedStorage())
+        self.assertEqual(response.status_int, 503)
+
+    def test_timeout_isolation(self):
+        '''Handler finishing after timeout doesn't change env and data'''
+        done = threading.Event()
+        errors = []
+        def handler(env, data, nh):
+            self.release.wait()
+            data.late = True
+            env.request.add_prefix('/a')
+            done.set()
+            raise ValueError('late')
+        app = web.offload(handler, pool=1, timeout=0.01)
+        env = VersionedStorage(request=web.Request.blank('/a/b'))
+        data = VersionedStorage(count=0)
+        exception = web.core.logger.exception
+        web.core.logger.exception = lambda *args: errors.append(args)
+        try:
+            self.assertEqual(app(env, data).status_int, 503)
+            self.release.set()
+            done.wait()
+            app.pool.close()
+            app.pool.join()
+        finally:
+            web.core.logger.exception = exception
+        self.assertEqual(data.as_dict(), {'count': 0})
+        self.assertEqual(env.request.prefixed_path, '/a/b')
+        self.assertEqual(len(errors), 1)
+
+    def test_changes(self):
+        '''Changes of offloaded handler are copied back'''
+        self.release.set()
+        def handler(env, data, nh):
+            del data.old
+            data.new = 1
+            env.request.add_prefix('/a')
+            return nh(env, data)
+        app = web.offload(handler) | web.match('/b', 'b') | \
+                (lambda e, d, n: Response())
+        env = VersionedStorage(request=web.Request.blank('/a/b'))
+        request = env.request
+        data = VersionedStorage(old=0)
+        self.assertEqual(app(env, data).status_int, 200)
+        self.assertEqual(data.as_dict(), {'new': 1})
+        self.assert_(env.request is request)
+        self.assertEqual(env.current_url_name, 'b')
+        self.assertEqual(request.prefixed_path, '/b')
+
+    def test_request_cache(self):
+        '''Values cached on request by offloaded handler are kept'''
+        self.release.set()
+        body = '\r\n'.join(['--BoUnDaRy',
+                             'Content-Disposition: form-data; name="a"',
+                             '', '1', '--BoUnDaRy--', ''])
+        request = web.Request.blank('/', method='POST', body=body,
+                content_type='multipart/form-data; boundary=BoUnDaRy')
+        # not seekable input, like socket
+        class Input(object):
+            read = StringIO(body).read
+        request.environ['wsgi.input'] = Input()
+        request.environ['webob.is_body_seekable'] = False
+        def inner(env, data, nh):
+            self.assertEqual(env.request.POST['a'], '1')
+            return nh(env, data)
+        def outer(env, data, nh):
+            response = nh(env, data)
+            self.assertEqual(env.request.POST['a'], '1')
+            return response
+        app = web.handler(outer) | web.offload(inner) | \
+                (lambda e, d, n: Response())
+        env = VersionedStorage(request=request)
+        self.assertEqual(app(env, VersionedStorage()).status_int, 200)
+
+    def test_max_queue(self):
+        '''Requests over queue limit are rejected'''
+        app = web.offload(self.blocking, pool=1, max_queue=0, retry_after=10) | \
+                (lambda e, d, n: Response())
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+                                    app(VersionedStorage(), VersionedStorage())))
+        thread.start()
+        while not app._pending:
+            time.sleep(0.001)
+        response = app(VersionedStorage(), VersionedStorage())
+        self.assertEqual(response.status_int, 503)
+        self.assertEqual(response.headers['Retry-After'], '10')
+        self.release.set()
+        thread.join()
+        self.assertEqual(results[0].status_int, 200)
+        self.assertEqual(app._pending, 0)
+
+    def test_shared_pool(self):
+        '''Offloads sharing thread pool'''
+        self.release.set()
+        pool = ThreadPool(1)
+        app = web.cases(web.match('/a', 'a') | web.offload(self.blocking, pool=pool),
+                        web.match('/b', 'b') | web.offload(self.blocking, pool=pool)) | \
+                (lambda e, d, n: Response())
+        self.assertEqual(sorted(web.locations(app)), ['a', 'b'])
+        env = VersionedStorage(request=web.Request.blank('/b'))
+        self.assertEqual(app(env, VersionedStorage()).status_int, 200)
+
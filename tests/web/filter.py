@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
-__all__ = ['UrlTemplateTests', 'Prefix', 'Match', 'Subdomain']
-
+__all__ = ['UrlTemplateTests', 'Prefix', 'Match', 'Subdomain', 'CompiledCases',
+           'Methods', 'RouteCache', 'StaticFiles', 'CachedStaticFiles',
+           'Compress', 'ETag']
+
+import os
+import gzip
+import zlib
+import shutil
+import tempfile
 import unittest
 from insanities import web
-from insanities.web.url import UrlTemplate
+from insanities.web.url import UrlTemplate, Converter, Integer, ConvertError
 from insanities.web.http import Request, Response
+from insanities.utils.storage import VersionedStorage
+from insanities.utils.lru import LRUCache
+from StringIO import StringIO
 
 class UrlTemplateTests(unittest.TestCase):
 
@@ -61,6 +71,17 @@ class UrlTemplateTests(unittest.TestCase):
         ut = UrlTemplate('<message_uid>')
         self.assertEqual(ut(message_uid='uid'), 'uid')
 
+    def test_static(self):
+        'UrlTemplate without params is matched without regex'
+        ut = UrlTemplate(u'/з/')
+        self.assert_(ut._is_static)
+        self.assertEqual(ut.match('/%D0%B7/'), (True, {}))
+        self.assertEqual(ut.match('/%D0%B7/1'), (False, {}))
+        ut = UrlTemplate(u'/з/', match_whole_str=False)
+        self.assertEqual(ut.match('/%D0%B7/1'), (True, {}))
+        self.assertEqual(ut.match('/%D0%B7'), (False, {}))
+        self.assert_(not UrlTemplate('/<int:id>')._is_static)
+
     def test_incorrect_converter_def(self):
         self.assertRaises(ValueError, UrlTemplate, '<int:id:>')
 
@@ -127,6 +148,30 @@ class Prefix(unittest.TestCase):
         self.assertEqual(web.ask(app, encoded).status_int, 200)
 
 
+    def test_failed_branch(self):
+        '''Prefix of failed branch is not kept'''
+        app = web.cases(
+            web.prefix('/a') | web.match('/x', 'x') | (lambda e, d, n: Response('x')),
+            web.prefix('/a') | web.match('/y', 'y') | (lambda e, d, n: Response('y')),
+            web.subdomain('news') | web.match('/a/z', 'z1'),
+            web.match('/a/z', 'z2') | (lambda e, d, n: Response(e.request.subdomain)))
+        for app in (app, app.compile()):
+            self.assertEqual(web.ask(app, '/a/y').body, 'y')
+            self.assertEqual(web.ask(app, 'http://news.example.com/a/z').body,
+                             'news.example.com')
+
+    def test_path_changed(self):
+        '''Prefixed path follows request path'''
+        request = web.Request.blank('/a/b/c')
+        request.add_prefix('/a')
+        self.assertEqual(request.prefixed_path, '/b/c')
+        self.assertEqual(request.prefixed_path_qs, '/b/c')
+        request.path_info_pop()
+        self.assertEqual(request.prefixed_path, '/b/c')
+        request.environ['PATH_INFO'] = '/d'
+        self.assertEqual(request.prefixed_path, '/d')
+
+
 class Subdomain(unittest.TestCase):
 
     def test_subdomain(self):
@@ -221,3 +266,507 @@ class Match(unittest.TestCase):
 
         self.assert_(web.ask(app, '/second/42/') is None)
         self.assert_(web.ask(app, '/second/42s') is None)
+
+
+class CompiledCases(unittest.TestCase):
+
+    def test_dispatch(self):
+        '''Compiled cases tries only handlers matching the path'''
+        called = []
+        def handler(name):
+            def h(env, data, nx):
+                called.append(name)
+                return Response(body=name)
+            return h
+
+        app = web.cases(
+            web.match('/', 'index') | handler('index'),
+            web.prefix('/docs') | web.cases(
+                web.match('/', 'docs') | handler('docs'),
+                web.match('/<int:id>', 'doc') | handler('doc')),
+            web.match('/doc', 'doc2') | handler('doc2'),
+            web.namespace('news') | web.match('/news', 'news') | handler('news'),
+            compiled=True)
+
+        self.assertEqual(web.ask(app, '/').body, 'index')
+        self.assertEqual(web.ask(app, '/docs/').body, 'docs')
+        self.assertEqual(web.ask(app, '/docs/1').body, 'doc')
+        self.assertEqual(web.ask(app, '/doc').body, 'doc2')
+        self.assertEqual(web.ask(app, '/news').body, 'news')
+        self.assert_(web.ask(app, '/about') is None)
+        self.assertEqual(app._candidates('/docs/'), app.handlers[1:2])
+        self.assertEqual(app._candidates('/doc'), app.handlers[2:3])
+        self.assertEqual(app._candidates('news'), [])
+
+    def test_order(self):
+        '''Compiled cases keeps order of handlers'''
+        app = web.cases(
+            web.prefix('/a') | (lambda e, d, n: Response(body='prefix')),
+            (lambda e, d, n: Response(body='any')),
+            web.match('/a/b', 'ab') | (lambda e, d, n: Response(body='match')),
+            compiled=True)
+        self.assertEqual(web.ask(app, '/a/b').body, 'prefix')
+        self.assertEqual(web.ask(app, '/b').body, 'any')
+
+    def test_converter_fallback(self):
+        '''Compiled cases tries next match if converter rejects value'''
+        class Even(Integer):
+            name = 'even'
+            def to_python(self, value, **kwargs):
+                if Integer.to_python(self, value) % 2:
+                    raise ConvertError(self.name, value)
+                return int(value)
+        app = web.cases(
+            web.match('/<even:id>', 'even', convs=[Even]) |
+                (lambda e, d, n: Response(body='even')),
+            web.match('/<int:id>', 'odd') | (lambda e, d, n: Response(body='odd')),
+            compiled=True)
+        self.assertEqual(web.ask(app, '/2').body, 'even')
+        self.assertEqual(web.ask(app, '/3').body, 'odd')
+        self.assert_(web.ask(app, '/a') is None)
+        self.assertEqual(app._candidates('/3'), app.handlers)
+        self.assertEqual(app._candidates('/3/'), [])
+
+    def test_static(self):
+        '''Compiled cases finds static routes by path'''
+        app = web.cases(
+            web.match('/<name>', 'name') | (lambda e, d, n: None),
+            web.match('/about', 'about') | (lambda e, d, n: Response(body='about')),
+            web.match('/<int:id>', 'id') | (lambda e, d, n: Response(body='id')),
+            web.match('/1', 'one') | (lambda e, d, n: Response(body='one')),
+            compiled=True)
+        self.assertEqual(web.ask(app, '/about').body, 'about')
+        self.assertEqual(web.ask(app, '/1').body, 'id')
+        self.assertEqual(app._candidates('/about'), app.handlers[:3])
+        self.assertEqual(app._candidates('/1'),
+                         [app.handlers[0]] + app.handlers[2:])
+        self.assertEqual(app._candidates('/about/'), [])
+
+    def test_next_handler(self):
+        '''Compiled cases with handlers appended after creation'''
+        app = web.cases(web.namespace('a'), compiled=True)
+        self.assertEqual(app._candidates('/b'), app.handlers)
+        app = app | web.match('/a', 'a') | (lambda e, d, n: Response())
+        self.assertEqual(app._candidates('/b'), [])
+        self.assertEqual(web.ask(app, '/a').status_int, 200)
+
+
+class Methods(unittest.TestCase):
+
+    def test_dispatch(self):
+        '''Dispatching by request method'''
+        app = web.match('/', 'index') | web.methods(
+            get=lambda e, d, n: Response(body='get'),
+            post=lambda e, d, n: Response(body='post'))
+
+        self.assertEqual(web.ask(app, '/').body, 'get')
+        self.assertEqual(web.ask(app, '/', data={'a': '1'}).body, 'post')
+        self.assert_(web.ask(app, '/a') is None)
+
+    def test_head(self):
+        '''HEAD request is handled by GET handler'''
+        app = web.methods(get=lambda e, d, n: Response(body='get'))
+        env = VersionedStorage(request=Request.blank('/', method='HEAD'))
+        self.assertEqual(app(env, VersionedStorage()).body, 'get')
+
+    def test_not_allowed(self):
+        '''Method not allowed response'''
+        app = web.cases(
+            web.match('/', 'index') | web.methods(
+                get=lambda e, d, n: Response(body='get')),
+            lambda e, d, n: Response(body='other'))
+        response = web.ask(app, '/', data={'a': '1'})
+        self.assertEqual(response.status_int, 405)
+        self.assertEqual(response.headers['Allow'], 'GET, HEAD')
+
+    def test_chain(self):
+        '''Methods with next handler and locations'''
+        app = web.match('/', 'index') | web.methods(
+            get=web.namespace('get'),
+            post=web.namespace('post')) | (lambda e, d, n: Response(body=e.namespace))
+        self.assertEqual(web.ask(app, '/').body, 'get')
+        self.assertEqual(web.ask(app, '/', data={'a': '1'}).body, 'post')
+
+
+class RouteCache(unittest.TestCase):
+
+    def test_cache(self):
+        '''Routing results are stored in env.route_cache'''
+        def handler(env, data, nx):
+            return Response(body=str(data.id))
+        app = web.cases(
+            web.prefix('/docs') | web.match('/<int:id>', 'doc') | handler,
+            compiled=True)
+        cache = LRUCache(10)
+        env = dict(route_cache=cache)
+
+        self.assertEqual(web.ask(app, '/docs/1', additional_env=env).body, '1')
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(web.ask(app, '/docs/1', additional_env=env).body, '1')
+        self.assertEqual(web.ask(app, '/docs/2', additional_env=env).body, '2')
+        self.assertEqual(len(cache), 6)
+        self.assert_(web.ask(app, '/docs/a', additional_env=env) is None)
+
+    def test_env_converter(self):
+        '''Match results of converters depending on env are not cached'''
+        class User(Converter):
+            name = 'user'
+            def to_python(self, value, env=None):
+                return env.users[value]
+        app = web.match('/<user:user>', 'user', convs=[User]) | \
+                (lambda e, d, n: Response(body=d.user))
+        cache = LRUCache(10)
+        env = dict(route_cache=cache, users={'1': 'john'})
+        self.assertEqual(web.ask(app, '/1', additional_env=env).body, 'john')
+        self.assertEqual(len(cache), 0)
+
+    def test_as_wsgi(self):
+        '''Route cache of WSGI application'''
+        def handler(env, data, nx):
+            self.assertEqual(len(env.route_cache), 1)
+            return Response()
+        app = web.match('/', 'index') | handler
+        wsgi_app = app.as_wsgi(route_cache=10)
+        statuses = []
+        body = wsgi_app(Request.blank('/').environ,
+                        lambda status, headers: statuses.append(status))
+        self.assertEqual(statuses, ['200 OK'])
+
+
+class StaticFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        with open(os.path.join(self.location, 'app.css'), 'wb') as f:
+            f.write('body {}\n' * 10)
+        self.app = web.static_files(self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_file(self):
+        '''Static file response'''
+        response = web.ask(self.app, '/static/app.css')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'text/css')
+        self.assertEqual(response.content_length, 80)
+        self.assertEqual(response.body, 'body {}\n' * 10)
+        self.assert_(response.etag)
+        self.assert_(response.last_modified)
+        self.assert_(web.ask(self.app, '/app.css') is None)
+        self.assertEqual(web.ask(self.app, '/static/').status_int, 404)
+        self.assertEqual(web.ask(self.app, '/static/../app.css').status_int,
+                         200)
+        self.assertEqual(web.ask(self.app, '/static/missing.css').status_int,
+                         404)
+
+    def test_not_modified(self):
+        '''Conditional requests for static file'''
+        response = web.ask(self.app, '/static/app.css')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, '')
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.status_int, 200)
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_int, 304)
+        response = web.ask(self.app, '/static/app.css', headers={
+                'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(response.status_int, 200)
+
+    def test_head(self):
+        '''HEAD request for static file'''
+        response = web.ask(self.app, '/static/app.css', method='HEAD')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_length, 80)
+
+    def test_range(self):
+        '''Range requests for static file'''
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Range': 'bytes=8-15'})
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 8-15/80')
+        self.assertEqual(response.content_length, 8)
+        self.assertEqual(response.body, 'body {}\n')
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Range': 'bytes=100-'})
+        self.assertEqual(response.status_int, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */80')
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Range': 'bytes=0-1',
+                                    'If-Range': '"other"'})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_length, 80)
+
+    def test_manifest(self):
+        '''Fingerprinted static files'''
+        os.mkdir(os.path.join(self.location, 'js'))
+        with open(os.path.join(self.location, 'js', 'app.js'), 'wb') as f:
+            f.write('alert(1)')
+        output = os.path.join(self.location, 'manifest.json')
+        manifest = web.static_files.build_manifest(self.location, output)
+        self.assertEqual(sorted(manifest), ['app.css', 'js/app.js'])
+        self.assert_(manifest['js/app.js'].startswith('js/app.'))
+        self.assert_(manifest['js/app.js'].endswith('.js'))
+        self.assertEqual(web.static_files.build_manifest(self.location, output),
+                         manifest)
+
+        self.app.__init__(self.location, manifest=output)
+        url = self.app.construct_reverse()('/js/app.js')
+        self.assertEqual(url, '/static/' + manifest['js/app.js'])
+        self.assertEqual(self.app.construct_reverse()('other.js'), '/static/other.js')
+        response = web.ask(self.app, url)
+        self.assertEqual(response.body, 'alert(1)')
+        self.assertEqual(response.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        response = web.ask(self.app, '/static/js/app.js')
+        self.assertEqual(response.body, 'alert(1)')
+        self.assert_('Cache-Control' not in response.headers)
+        self.assertEqual(web.ask(self.app, '/static/js/app.0123456789ab.js')
+                         .status_int, 404)
+
+
+class CachedStaticFiles(StaticFiles):
+
+    def setUp(self):
+        StaticFiles.setUp(self)
+        self.app = web.static_files(self.location, cache_size=1024)
+
+    def test_cached(self):
+        '''Static file is served from memory until it is changed'''
+        file_path = os.path.join(self.location, 'app.css')
+        self.assertEqual(web.ask(self.app, '/static/app.css').body,
+                         'body {}\n' * 10)
+        self.assert_(file_path in self.app.cache)
+        with open(file_path, 'wb') as f:
+            f.write('p {}\n')
+        os.utime(file_path, (0, 0))
+        response = web.ask(self.app, '/static/app.css')
+        self.assertEqual(response.body, 'p {}\n')
+        self.assertEqual(response.last_modified.year, 1970)
+
+    def test_gzip(self):
+        '''Compressible static file is gzipped in memory'''
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        body = gzip.GzipFile(fileobj=StringIO(response.body)).read()
+        self.assertEqual(body, 'body {}\n' * 10)
+        etag = response.headers['ETag']
+        self.assertNotEqual(etag, web.ask(self.app, '/static/app.css')
+                                        .headers['ETag'])
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Accept-Encoding': 'gzip',
+                                    'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+    def test_precompressed(self):
+        '''Precompressed siblings of static file'''
+        with open(os.path.join(self.location, 'app.css.br'), 'wb') as f:
+            f.write('brotli')
+        with open(os.path.join(self.location, 'app.css.gz'), 'wb') as f:
+            f.write('gzip')
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.content_encoding, 'br')
+        self.assertEqual(response.body, 'brotli')
+        response = web.ask(self.app, '/static/app.css',
+                           headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(response.body, 'gzip')
+
+    def test_size_limit(self):
+        '''Large static files are not cached'''
+        with open(os.path.join(self.location, 'big.txt'), 'wb') as f:
+            f.write('x' * 2048)
+        web.ask(self.app, '/static/app.css')
+        self.assertEqual(web.ask(self.app, '/static/big.txt').content_length,
+                         2048)
+        self.assertEqual(len(self.app.cache), 1)
+        self.assert_(self.app.cache.size <= 1024)
+
+
+class Compress(unittest.TestCase):
+
+    body = '<p>compressible</p>' * 100
+
+    def test_gzip(self):
+        '''Response compression'''
+        app = web.compress() | (lambda e, d, n: Response(self.body))
+        response = web.ask(app, '/',
+                           headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assert_(response.content_length < len(self.body))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.body)).read(),
+                         self.body)
+        response = web.ask(app, '/', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(response.content_encoding, 'deflate')
+        self.assertEqual(zlib.decompress(response.body), self.body)
+
+    def test_not_compressed(self):
+        '''Responses which are not compressed'''
+        app = web.compress() | (lambda e, d, n: Response(self.body))
+        response = web.ask(app, '/')
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.body, self.body)
+        headers = {'Accept-Encoding': 'gzip'}
+        app = web.compress() | (lambda e, d, n: Response('<p>short</p>'))
+        response = web.ask(app, '/', headers=headers)
+        self.assertEqual(response.content_encoding, None)
+        self.assert_('Vary' not in response.headers)
+        app = web.compress() | \
+                (lambda e, d, n: Response(self.body, content_type='image/png'))
+        self.assertEqual(web.ask(app, '/', headers=headers).content_encoding,
+                         None)
+        app = web.compress() | (lambda e, d, n: Response(self.body, status=404))
+        self.assertEqual(web.ask(app, '/', headers=headers).content_encoding,
+                         None)
+        app = web.compress() | (lambda e, d, n: None)
+        self.assert_(web.ask(app, '/', headers=headers) is None)
+
+    def test_file(self):
+        '''Compression of static file'''
+        location = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(location, 'app.css'), 'wb') as f:
+                f.write('body {}\n' * 400)
+            app = web.compress(min_size=10) | web.static_files(location)
+            headers = {'Accept-Encoding': 'gzip'}
+            response = web.ask(app, '/static/app.css', headers=headers)
+            self.assertEqual(response.content_encoding, 'gzip')
+            self.assertEqual(response.content_length, None)
+            body = ''.join(response.app_iter)
+            response.app_iter.close()
+            self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(),
+                             'body {}\n' * 400)
+            self.assert_(response.headers['ETag'].startswith('W/"'))
+            self.assert_('Accept-Ranges' not in response.headers)
+            not_modified = web.ask(app, '/static/app.css', headers={
+                    'Accept-Encoding': 'gzip',
+                    'If-None-Match': response.headers['ETag']})
+            self.assertEqual(not_modified.status_int, 304)
+            head = web.ask(app, '/static/app.css', method='HEAD',
+                           headers=headers)
+            self.assertEqual(head.content_encoding, 'gzip')
+            self.assertEqual(head.content_length, None)
+            self.assertEqual(head.headers['ETag'], response.headers['ETag'])
+            self.assertEqual(head.headers['Vary'], response.headers['Vary'])
+        finally:
+            shutil.rmtree(location)
+
+    def test_head(self):
+        '''Response to HEAD request has the same headers'''
+        headers = {'Accept-Encoding': 'gzip'}
+        app = web.compress() | (lambda e, d, n: Response(self.body))
+        get = web.ask(app, '/', headers=headers)
+        head = web.ask(app, '/', method='HEAD', headers=headers)
+        self.assertEqual(head.content_encoding, get.content_encoding)
+        self.assertEqual(head.headers['Vary'], get.headers['Vary'])
+        self.assert_('Content-Length' not in head.headers)
+
+    def test_streaming(self):
+        '''Streaming response is compressed incrementally'''
+        sent = []
+        def app_iter():
+            for i in range(100):
+                sent.append(i)
+                yield '<p>%d</p>' % i
+        def handler(env, data, nh):
+            response = Response(app_iter=app_iter())
+            response.vary = ('Cookie',)
+            return response
+        response = web.ask(web.compress() | handler, '/',
+                           headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Cookie, Accept-Encoding')
+        self.assertEqual(response.content_length, None)
+        self.assertEqual(sent, [])
+        body = ''.join(response.app_iter)
+        self.assertEqual(len(sent), 100)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(),
+                         ''.join(['<p>%d</p>' % i for i in range(100)]))
+
+
+class ETag(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def page(self, env, data, nh):
+        self.calls.append(env.request.path)
+        return Response('page %s' % data.revision)
+
+    def test_body_hash(self):
+        '''ETag made of response body'''
+        app = web.etag() | self.page
+        response = web.ask(app, '/', additional_data={'revision': 1})
+        self.assertEqual(response.status_int, 200)
+        etag = response.headers['ETag']
+        self.assert_(etag.startswith('W/"'))
+        response = web.ask(app, '/', headers={'If-None-Match': etag},
+                           additional_data={'revision': 1})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, '')
+        self.assertEqual(response.headers['ETag'], etag)
+        response = web.ask(app, '/', headers={'If-None-Match': etag},
+                           additional_data={'revision': 2})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_version(self):
+        '''ETag made of version key'''
+        app = web.etag(lambda env, data: data.revision) | self.page
+        etag = web.ask(app, '/', additional_data={'revision': 1}) \
+                .headers['ETag']
+        response = web.ask(app, '/', headers={'If-None-Match': etag},
+                           additional_data={'revision': 1})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(self.calls), 1)
+        response = web.ask(app, '/', headers={'If-None-Match': etag},
+                           additional_data={'revision': 2})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_head(self):
+        '''Response to HEAD request gets ETag of version only'''
+        def page(env, data, nh):
+            if env.request.headers_only:
+                return Response()
+            return self.page(env, data, nh)
+        for version, has_etag in ((None, False),
+                                  (lambda env, data: data.revision, True)):
+            app = web.etag(version) | page
+            get = web.ask(app, '/', additional_data={'revision': 1})
+            head = web.ask(app, '/', method='HEAD',
+                           additional_data={'revision': 1})
+            self.assertEqual(head.status_int, 200)
+            self.assertEqual('ETag' in head.headers, has_etag)
+            if has_etag:
+                self.assertEqual(head.headers['ETag'], get.headers['ETag'])
+
+    def test_compressed(self):
+        '''Weak ETag is not changed by compression'''
+        app = web.compress(min_size=0) | web.etag() | self.page
+        response = web.ask(app, '/', headers={'Accept-Encoding': 'gzip'},
+                           additional_data={'revision': 1})
+        self.assertEqual(response.content_encoding, 'gzip')
+        headers = {'Accept-Encoding': 'gzip',
+                   'If-None-Match': response.headers['ETag']}
+        response = web.ask(app, '/', headers=headers,
+                           additional_data={'revision': 1})
+        self.assertEqual(response.status_int, 304)
+
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['WsgiTests', 'FileIterTests', 'HeadRequests', 'MultipartTests',
+           'BodyLimits', 'JSONTests']
+
+import os
+import cgi
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from insanities.templates import Template
+from insanities import web
+from insanities.web.http import Request, Response, FileIter, LimitedInput, \
+        JSONResponse
+from insanities.web.multipart import MultipartParser, MultipartFile, \
+        MultipartError, MultipartLimitError
+from webob.exc import HTTPBadRequest, HTTPRequestEntityTooLarge
+from insanities.utils.storage import VersionedStorage
+
+
+def call_wsgi(app, request, **kwargs):
+    '''Calls WSGI application, returns (status, headers, app_iter)'''
+    result = []
+    def start_response(status, headers):
+        result.extend([status, dict(headers)])
+    result.append(app.as_wsgi(**kwargs)(request.environ, start_response))
+    return result
+
+
+class WsgiTests(unittest.TestCase):
+
+    def test_body(self):
+        'WSGI application response body'
+        app = web.handler(lambda e, d, n: Response(body='body'))
+        status, headers, app_iter = call_wsgi(app, Request.blank('/'))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Length'], '4')
+        self.assertEqual(list(app_iter), ['body'])
+
+    def test_not_found(self):
+        'WSGI application returning None'
+        app = web.handler(lambda e, d, n: None)
+        status, headers, app_iter = call_wsgi(app, Request.blank('/'))
+        self.assertEqual(status, '404 Not Found')
+
+    def test_app_iter(self):
+        'WSGI application passes response app_iter through'
+        def chunks():
+            yield 'a'
+            yield 'b'
+        generator = chunks()
+        app = web.handler(lambda e, d, n: Response(app_iter=generator))
+        status, headers, app_iter = call_wsgi(app, Request.blank('/'))
+        self.assert_(app_iter is generator)
+        self.assertEqual(list(app_iter), ['a', 'b'])
+
+    def test_file_wrapper(self):
+        'WSGI application uses wsgi.file_wrapper for files'
+        f = StringIO('data')
+        app = web.handler(lambda e, d, n: Response(app_iter=FileIter(f)))
+        request = Request.blank('/')
+        request.environ['wsgi.file_wrapper'] = lambda f, size: ('wrapped', f, size)
+        status, headers, app_iter = call_wsgi(app, request)
+        self.assertEqual(app_iter, ('wrapped', f, FileIter.block_size))
+        # without file wrapper
+        f = StringIO('data')
+        status, headers, app_iter = call_wsgi(app, Request.blank('/'))
+        self.assertEqual(list(app_iter), ['data'])
+
+
+class FileIterTests(unittest.TestCase):
+
+    def test_chunks(self):
+        'FileIter chunks'
+        self.assertEqual(list(FileIter(StringIO('abcde'), block_size=2)),
+                         ['ab', 'cd', 'e'])
+
+    def test_length(self):
+        'FileIter with length'
+        f = StringIO('abcdef')
+        f.seek(1)
+        self.assertEqual(list(FileIter(f, block_size=2, length=3)),
+                         ['bc', 'd'])
+        self.assertEqual(list(FileIter(StringIO('ab'), length=5)), ['ab'])
+
+    def test_close(self):
+        'FileIter closes file'
+        f = StringIO('a')
+        FileIter(f).close()
+        self.assert_(f.closed)
+
+
+class HeadRequests(unittest.TestCase):
+
+    def test_wsgi(self):
+        '''WSGI application sends no body for HEAD request'''
+        closed = []
+        class Body(object):
+            def __iter__(self):
+                return iter(['body'])
+            def close(self):
+                closed.append(True)
+        def handler(env, data, nh):
+            response = Response(app_iter=Body())
+            response.content_length = 4
+            return response
+        app = web.handler(handler)
+        status, headers, app_iter = call_wsgi(app, Request.blank('/',
+                                                    method='HEAD'))
+        self.assertEqual(headers['Content-Length'], '4')
+        self.assertEqual(list(app_iter), [])
+        self.assertEqual(closed, [True])
+
+    def test_template(self):
+        '''Template is not rendered for HEAD request'''
+        rendered = []
+        class Engine(object):
+            def __init__(self, dirs, cache=False):
+                pass
+            def render(self, name, **kw):
+                rendered.append(name)
+                return u'page \u0444'
+        directory = tempfile.mkdtemp()
+        try:
+            open(os.path.join(directory, 'page.fake'), 'w').close()
+            template = Template(directory, engines={'fake': Engine})
+            app = web.handler(template.render_to('page'))
+            request = Request.blank('/', method='HEAD')
+            self.assert_(request.headers_only)
+            status, headers, app_iter = call_wsgi(app, request)
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(headers['Content-Type'], 'text/html; charset=UTF-8')
+            self.assert_('Content-Length' not in headers)
+            self.assertEqual(rendered, [])
+            env = VersionedStorage(request=request)
+            response = app(env, VersionedStorage())
+            self.assertEqual(response.body, 'page \xd1\x84')
+            self.assertEqual(rendered, ['page.fake'])
+            response = app(VersionedStorage(request=Request.blank('/')),
+                           VersionedStorage())
+            self.assertEqual(response.content_length, 7)
+        finally:
+            shutil.rmtree(directory)
+
+
+def multipart_body(fields, files, boundary='BoUnDaRy'):
+    lines = ['preamble']
+    for name, value in fields:
+        lines += ['--' + boundary,
+                  'Content-Disposition: form-data; name="%s"' % name,
+                  '', value]
+    for name, filename, value in files:
+        lines += ['--' + boundary,
+                  'Content-Disposition: form-data; name="%s"; filename="%s"' %
+                        (name, filename),
+                  'Content-Type: text/plain', '', value]
+    lines += ['--' + boundary + '--', '']
+    return '\r\n'.join(lines)
+
+
+class MultipartTests(unittest.TestCase):
+
+    def request(self, body, boundary='BoUnDaRy'):
+        return Request.blank('/', method='POST', body=body,
+                             content_type='multipart/form-data; boundary=' +
+                                          boundary)
+
+    def test_post_files(self):
+        '''POST and FILES of multipart request'''
+        body = multipart_body([('a', '1'), ('b', '\xd1\x84'), ('a', '')],
+                              [('f', 'f.txt', 'file\r\ncontent')])
+        request = self.request(body)
+        self.assertEqual(request.POST.getall('a'), [u'1', u''])
+        self.assertEqual(request.POST['b'], u'\u0444')
+        self.assertEqual(request.FILES.keys(), ['f'])
+        f = request.FILES['f']
+        self.assert_(isinstance(f, cgi.FieldStorage))
+        self.assertEqual(f.filename, u'f.txt')
+        self.assertEqual(f.type, 'text/plain')
+        self.assertEqual(f.value, 'file\r\ncontent')
+        self.assertEqual(f.file.read(), 'file\r\ncontent')
+        # webob API uses the same data
+        self.assertEqual(request.params['b'], u'\u0444')
+        self.assert_(request.str_POST['f'].file is f.file)
+
+    def test_urlencoded(self):
+        '''POST of urlencoded request'''
+        request = Request.blank('/', POST={'a': '1'})
+        self.assertEqual(request.POST['a'], u'1')
+        self.assertEqual(request.FILES.keys(), [])
+        request = Request.blank('/')
+        self.assertEqual(request.POST.keys(), [])
+        self.assertEqual(request.FILES.keys(), [])
+
+    def test_chunks(self):
+        '''Multipart body read in small chunks'''
+        body = multipart_body([('a', 'x' * 20)], [('f', 'f.txt', 'y' * 50)])
+        for block_size in (1, 3, 7, 64):
+            parser = MultipartParser(StringIO(body), 'BoUnDaRy', len(body),
+                                     memory_limit=10, block_size=block_size)
+            fields, files = parser.parse()
+            self.assertEqual(fields, [('a', 'x' * 20)])
+            name, f = files[0]
+            self.assert_(isinstance(f, MultipartFile))
+            # spooled to disk
+            self.assert_(f.file._rolled)
+            self.assertEqual(f.read(), 'y' * 50)
+
+    def test_errors(self):
+        '''Multipart size limits and malformed bodies'''
+        body = multipart_body([('a', 'x' * 20)], [('f', 'f.txt', 'y' * 50)])
+        parser = MultipartParser(StringIO(body), 'BoUnDaRy', len(body),
+                                 part_limit=30)
+        self.assertRaises(MultipartLimitError, parser.parse)
+        parser = MultipartParser(StringIO(body), 'BoUnDaRy', len(body),
+                                 total_limit=100)
+        self.assertRaises(MultipartLimitError, parser.parse)
+        parser = MultipartParser(StringIO(body[:-20]), 'BoUnDaRy', len(body) - 20)
+        self.assertRaises(MultipartError, parser.parse)
+
+        request = self.request(body)
+        request.max_part_size = 30
+        self.assertRaises(HTTPRequestEntityTooLarge, lambda: request.POST)
+        self.assertRaises(HTTPBadRequest, lambda: self.request(body, '').POST)
+
+
+class BodyLimits(unittest.TestCase):
+
+    def setUp(self):
+        def handler(env, data, nh):
+            return Response(body=env.request.environ['wsgi.input'].read())
+        self.app = web.handler(handler)
+
+    def test_wsgi(self):
+        '''WSGI application request body limit'''
+        request = Request.blank('/', method='POST', body='x' * 10)
+        status, headers, app_iter = call_wsgi(self.app, request, max_body=5)
+        self.assertEqual(status, '413 Request Entity Too Large')
+        request = Request.blank('/', method='POST', body='x' * 10)
+        status, headers, app_iter = call_wsgi(self.app, request, max_body=10)
+        self.assertEqual(''.join(app_iter), 'x' * 10)
+        # body without Content-Length
+        request = Request.blank('/', method='POST', body='x' * 10)
+        del request.environ['CONTENT_LENGTH']
+        status, headers, app_iter = call_wsgi(self.app, request, max_body=5)
+        self.assertEqual(status, '413 Request Entity Too Large')
+
+    def test_filter(self):
+        '''max_body filter'''
+        app = web.max_body(5, per_route={'/upload/': 20, '/upload/big/': 100}) | \
+                self.app
+        def ask(url, size, content_length=True):
+            request = Request.blank(url, method='POST', body='x' * size)
+            if not content_length:
+                del request.environ['CONTENT_LENGTH']
+            return call_wsgi(app, request)
+        self.assertEqual(ask('/', 5)[0], '200 OK')
+        self.assertEqual(ask('/', 6)[0], '413 Request Entity Too Large')
+        self.assertEqual(ask('/', 6, False)[0], '413 Request Entity Too Large')
+        self.assertEqual(ask('/upload/', 20)[0], '200 OK')
+        self.assertEqual(ask('/upload/', 21)[0], '413 Request Entity Too Large')
+        self.assertEqual(ask('/upload/big/', 100)[0], '200 OK')
+
+    def test_multipart(self):
+        '''Multipart body limit'''
+        body = multipart_body([('a', 'x' * 20)], [])
+        request = Request.blank('/', method='POST', body=body,
+                                content_type='multipart/form-data; boundary=BoUnDaRy')
+        del request.environ['CONTENT_LENGTH']
+        request.environ['wsgi.input_terminated'] = True
+        request.limit_body(10)
+        self.assertRaises(HTTPRequestEntityTooLarge, lambda: request.POST)
+        request = Request.blank('/', method='POST', body=body,
+                                content_type='multipart/form-data; boundary=BoUnDaRy')
+        del request.environ['CONTENT_LENGTH']
+        request.environ['wsgi.input_terminated'] = True
+        self.assertEqual(request.POST['a'], 'x' * 20)
+        request = Request.blank('/', method='POST', body=body,
+                                content_type='multipart/form-data; boundary=BoUnDaRy')
+        self.assertRaises(HTTPRequestEntityTooLarge, request.limit_body, 10)
+        request.limit_body(len(body))
+        self.assertEqual(request.POST['a'], 'x' * 20)
+
+    def test_limited_input(self):
+        '''LimitedInput'''
+        stream = LimitedInput(StringIO('line\n' * 3), 10)
+        self.assertEqual(stream.readline(), 'line\n')
+        self.assertEqual(stream.read(5), 'line\n')
+        self.assertRaises(HTTPRequestEntityTooLarge, stream.read)
+        stream.seek(0)
+        stream.limit = 15
+        self.assertEqual(list(stream), ['line\n'] * 3)
+
+
+class JSONTests(unittest.TestCase):
+
+    def request(self, body, content_type='application/json'):
+        return Request.blank('/', method='POST', body=body,
+                             content_type=content_type)
+
+    def test_request(self):
+        '''JSON request body'''
+        request = self.request('{"a": [1, "\xd1\x84"]}')
+        self.assertEqual(request.json, {'a': [1, u'\u0444']})
+        self.assert_(request.json is request.json)
+        self.assertEqual(request.body, '{"a": [1, "\xd1\x84"]}')
+        self.assertEqual(self.request('{}', 'text/plain').json, None)
+        self.assertRaises(HTTPBadRequest, lambda: self.request('{').json)
+        request = self.request('[1]')
+        request.max_json_size = 2
+        self.assertRaises(HTTPRequestEntityTooLarge, lambda: request.json)
+
+    def test_response(self):
+        '''JSON response'''
+        response = JSONResponse({'a': [1, u'\u0444']}, status=201)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(response.body, '{"a":[1,"\\u0444"]}')
+        response = JSONResponse([1], dumps=lambda obj: 'dumped')
+        self.assertEqual(response.body, 'dumped')
+
+    def test_render_json(self):
+        '''render_json handler'''
+        def handler(env, data, nh):
+            data.items = [1, 2]
+            return nh(env, data)
+        app = web.handler(handler) | web.render_json()
+        response = web.ask(app, '/')
+        self.assertEqual(response.body, '{"items":[1,2]}')
+
@@ -188,4 +188,32 @@ class ReverseTests(unittest.TestCase):
         self.assertEqual(r('unicode3', slug=u'ю'), 'http://xn--o1a/%D0%B4/%D1%8E')
         self.assertEqual(r('unicode4', slug1=u'д', slug2=u'ю'), 'http://xn--o1a/%D0%B4/%D1%8E')
 
+    def test_bind(self):
+        'Reverse bound to env'
+        chain = web.subdomain('host') | web.cases(
+            web.match('/', 'index'),
+            web.namespace('docs') | web.match('/docs/<int:id>', 'doc'))
+        r = web.Reverse.from_handler(chain)
+        env = VersionedStorage(request=web.Request.blank('https://host:8000/'),
+                               namespace='docs')
+        bound = r.bind(env)
+        self.assertEqual(r('index'), 'http://host/')
+        self.assertEqual(bound('index'), 'https://host:8000/')
+        self.assertEqual(bound('.doc', id=1), 'https://host:8000/docs/1')
+        self.assert_(bound._routes is r._routes)
+        env = VersionedStorage(request=web.Request.blank('http://host/'))
+        self.assertEqual(bound.bind(env)('index'), 'http://host/')
+
+    def test_memo(self):
+        'Reverse remembers built paths'
+        chain = web.prefix('/docs') | web.match('/<int:id>', 'doc')
+        r = web.Reverse.from_handler(chain, memo_size=10)
+        self.assertEqual(r('doc', id=1), '/docs/1')
+        self.assertEqual(r('doc', id=2), '/docs/2')
+        self.assertEqual(r('doc', id=1), '/docs/1')
+        self.assertEqual(len(r._memo), 2)
+        self.assert_(r.bind(None)._memo is r._memo)
+        r = web.Reverse.from_handler(web.match('/<flag>', 'f'), memo_size=10)
+        self.assertEqual(r('f', flag=True), '/True')
+        self.assertEqual(r('f', flag=1), '/1')
 